@@ -1,7 +1,8 @@
 
-from datetime import datetime
+from datetime import datetime, timezone
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+from typing import Optional
 import os
 from bson import ObjectId
 
@@ -17,10 +18,7 @@ collection_movimiento = database['Sensores_movimiento']
 collection_sonido = database['Sensores_sonido']
 collection_magnetico = database['Sensores_magnetico']
 
-# Configuración del puerto serie
-#arduino_port = 'COM6'  # Cambia el puerto según tu configuración
-#baud_rate = 9600
-#ser = serial.Serial(arduino_port, baud_rate)
+# La lectura del puerto serie del Arduino está en gateway_serial.py (ARDUINO_PORT, ARDUINO_BAUD_RATE)
 
 # Modelos de datos
 class PyObjectId(ObjectId):
@@ -34,34 +32,93 @@ class PyObjectId(ObjectId):
             raise ValueError("Invalid ObjectId")
         return ObjectId(v)
     
+# Mongo guarda y devuelve las fechas en UTC sin zona; las fechas con zona (p. ej. "...Z")
+# se pasan a esa misma forma para poder compararlas con las que vienen de la base
+def utc_sin_zona(fecha):
+    if isinstance(fecha, datetime) and fecha.tzinfo is not None:
+        return fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+
+class LecturaBase(BaseModel):
+    @field_validator("fecha_hora", check_fields=False)
+    @classmethod
+    def fecha_utc(cls, fecha):
+        return utc_sin_zona(fecha)
+
+
 # Modelos de los sensores
-class SensorGas(BaseModel):
+# Los campos de lectura (sensor_id, valor medido, estado y fecha_hora) son opcionales para
+# seguir aceptando los registros de sensores que no traen una medición
+class SensorGas(LecturaBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     nombre: str
     ubicacion: str
     tipo: str
+    sensor_id: Optional[str] = None
+    nivel_gas: Optional[int] = None
+    estado: Optional[str] = None
+    fecha_hora: datetime = Field(default_factory=datetime.utcnow)
 
-class SensorHumo(BaseModel):
+class SensorHumo(LecturaBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     nombre: str
     ubicacion: str
     tipo: str
+    sensor_id: Optional[str] = None
+    nivel_humo: Optional[int] = None
+    nivel_toxicidad: Optional[int] = None
+    estado: Optional[str] = None
+    fecha_hora: datetime = Field(default_factory=datetime.utcnow)
 
-class SensorMovimiento(BaseModel):
+class SensorMovimiento(LecturaBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     nombre: str
     ubicacion: str
     tipo: str
+    sensor_id: Optional[str] = None
+    intensidad: Optional[int] = None
+    estado: Optional[str] = None
+    fecha_hora: datetime = Field(default_factory=datetime.utcnow)
 
-class SensorSonido(BaseModel):
+class SensorSonido(LecturaBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     nombre: str
     ubicacion: str
     tipo: str
+    sensor_id: Optional[str] = None
+    nivel_sonido: Optional[int] = None
+    estado: Optional[str] = None
+    fecha_hora: datetime = Field(default_factory=datetime.utcnow)
 
-class SensorMagnetico(BaseModel):
+class SensorMagnetico(LecturaBase):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     sensor_id: str
     ubicacion: str
     tipo: str
+    estado: Optional[str] = None
+    fecha_hora: datetime = Field(default_factory=datetime.utcnow)
+
+# Relación entre el tipo de sensor, su modelo y su colección
+SENSORES = {
+    "gas": (SensorGas, collection_gas),
+    "humo": (SensorHumo, collection_humo),
+    "movimiento": (SensorMovimiento, collection_movimiento),
+    "sonido": (SensorSonido, collection_sonido),
+    "magnetico": (SensorMagnetico, collection_magnetico),
+}
+
+# Campo con el valor medido en cada tipo de sensor (el magnético solo reporta estado)
+CAMPO_VALOR = {
+    "gas": "nivel_gas",
+    "humo": "nivel_humo",
+    "movimiento": "intensidad",
+    "sonido": "nivel_sonido",
+    "magnetico": None,
+}
 
+# Campos que se pueden pedir con fields= en los listados de lecturas de cada tipo
+CAMPOS_LECTURA = {
+    tipo: tuple(dict.fromkeys(("_id", "tipo", *(campo for campo in modelo.model_fields if campo != "id"))))
+    for tipo, (modelo, _) in SENSORES.items()
+}
@@ -31,16 +31,6 @@ class PyObjectId(ObjectId):
         return ObjectId(value)
     
     
-def serialize_object_id(obj):
-    """Convierte ObjectId a string en un diccionario"""
-    if isinstance(obj, dict):
-        return {key: serialize_object_id(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [serialize_object_id(element) for element in obj]
-    elif isinstance(obj, ObjectId):
-        return str(obj)
-    return obj
-
 # Definimos un modelo para representar las casas
 class CasaInfo(BaseModel):
     id: str  # Convertimos ObjectId a string
@@ -72,6 +62,15 @@ class Cliente(BaseModel):
             ObjectId: str  # Convierte ObjectId a string para la serialización
         }
 
+# Cliente en los listados: con fields= solo vienen los campos pedidos
+class ClienteResumen(BaseModel):
+    id: str | None = Field(None, alias="_id")
+    nombre: str | None = None
+    correo: str | None = None
+    rol: str | None = None
+    casas: Optional[List[Dict[str, str]]] = None
+
+
 class Casa(BaseModel):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     nombre: str
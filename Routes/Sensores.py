@@ -1,15 +1,40 @@
 # main.py
-import traceback
-from fastapi import WebSocket, HTTPException
-from Modelos.models import SensorMovimiento, collection_gas, collection_magnetico, collection_movimiento, collection_sonido, collection_humo, SensorGas, SensorMagnetico, SensorSonido, SensorHumo
+import base64
+import json
+import os
+import time
+from typing import Any, List, Optional
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException, Body, Request, Query, Depends, status
+from fastapi.responses import StreamingResponse
+from serializacion import RespuestaJSON, a_texto, campos_solicitados, proyeccion
+from Modelos.models import SensorMovimiento, SensorGas, SensorMagnetico, SensorSonido, SensorHumo, SENSORES, \
+    CAMPOS_LECTURA
 from bson import ObjectId
+from pymongo.errors import PyMongoError
 from datetime import datetime
-from bson.timestamp import Timestamp
 import asyncio
 from fastapi import APIRouter
+from almacenamiento import consultar_lecturas, coleccion_sensores, filtro_tipo, filtro_lecturas, \
+    actualizar_lectura, eliminar_lecturas, MODO_ALMACENAMIENTO
+from difusion import difusor, clave_casa, clave_sensor, clave_tipo, POLITICA, POLITICAS, LOTE_ESPERA_MS, \
+    LOTE_EVENTOS, LOTE_ESPERA_MAXIMA_MS, LOTE_EVENTOS_MAXIMO, LOTE_BYTES_MAXIMO
+import estado_actual
+import rollups
+from auth import check_token_blacklist, decode_access_token
+from retencion import consultar_historico
+from versiones import subir_version_sensores_de
+from ingesta import insertar_lecturas, guardar_lectura, metricas_escritura, importar_ndjson, validar_lectura, \
+    LecturaInvalida
 
 router = APIRouter()
 
+# Máximo de lecturas aceptadas en una sola petición por lotes
+LOTE_MAXIMO = int(os.getenv("SENSOR_BATCH_MAX", "5000"))
+# Tamaño máximo de página en los listados paginados
+LIMITE_PAGINA_MAXIMO = 1000
+# Segundos que tiene un socket de /ws/sensores para mandar su token
+ESPERA_AUTENTICACION = 10
+
 
 # Función auxiliar para serializar ObjectId a string
 def serialize_id(document):
@@ -17,129 +42,529 @@ def serialize_id(document):
     return document
 
 
-# Función genérica para insertar un sensor en una colección
-async def insert_sensor(sensor_data, collection):
-    result = await collection.insert_one(sensor_data)
-    return {**sensor_data, "id": str(result.inserted_id)}
+# Función genérica para insertar un sensor en la colección de su tipo
+async def insert_sensor(sensor_data, tipo):
+    inserted_id = await guardar_lectura(tipo, sensor_data)
+    return {**sensor_data, "id": str(inserted_id)}
 
 
 # Rutas para crear sensores
 @router.post("/sensor/movimiento/")
 async def create_sensor_movimiento(sensor: SensorMovimiento):
-    return await insert_sensor(sensor.dict(), collection_movimiento)
+    return await insert_sensor(sensor.dict(), "movimiento")
 
 @router.post("/sensor/humo/")
 async def create_sensor_humo(sensor: SensorHumo):
-    return await insert_sensor(sensor.dict(), collection_humo)
+    return await insert_sensor(sensor.dict(), "humo")
 
 @router.post("/sensor/gas/")
 async def create_sensor_humo(sensor: SensorGas):
-    return await insert_sensor(sensor.dict(), collection_gas)
+    return await insert_sensor(sensor.dict(), "gas")
 
 @router.post("/sensor/sonido/")
 async def create_sensor_humo(sensor: SensorSonido):
-    return await insert_sensor(sensor.dict(), collection_sonido)
+    return await insert_sensor(sensor.dict(), "sonido")
 
 @router.post("/sensor/magnetico/")
 async def create_sensor_deteccion(sensor: SensorMagnetico):
-    return await insert_sensor(sensor.dict(), collection_magnetico)
-
-
-# Función genérica para obtener todos los sensores de una colección
-async def get_all_sensors(collection):
-    sensors = []
-    async for sensor in collection.find():
-        sensors.append(serialize_id(sensor))
-    return sensors
+    return await insert_sensor(sensor.dict(), "magnetico")
+
+
+# Ruta para insertar lecturas de distintos tipos en una sola petición
+@router.post("/sensores/batch")
+async def create_sensores_batch(lecturas: List[Any] = Body(...)):
+    """
+    Recibe una lista mixta de lecturas; cada una indica su tipo en el campo `tipo`
+    (gas, humo, movimiento, sonido o magnetico).
+
+    - Valida cada lectura con el modelo de su tipo; un elemento que no es objeto solo falla él
+    - Guarda cada tipo con un solo insert_many no ordenado
+    - Devuelve el resultado de cada lectura en el orden recibido
+    """
+    if len(lecturas) > LOTE_MAXIMO:
+        raise HTTPException(
+            status_code=413,
+            detail=f"El lote excede el máximo de {LOTE_MAXIMO} lecturas"
+        )
+
+    resultados = await insertar_lecturas(lecturas)
+    insertadas = sum(1 for resultado in resultados if resultado["ok"])
+    return {
+        "insertadas": insertadas,
+        "fallidas": len(resultados) - insertadas,
+        "resultados": resultados
+    }
+
+
+# Ruta para importar lecturas históricas en formato NDJSON (una lectura JSON por línea)
+@router.post("/sensores/importar")
+async def importar_sensores(request: Request):
+    """
+    Pensada para que un hub suba de una vez las lecturas que guardó mientras estuvo sin conexión.
+
+    - El cuerpo se procesa conforme llega, sin cargarlo completo en memoria
+    - Cada línea se valida con el modelo de su tipo (campo `tipo`)
+    - Se guarda en bloques con insert_many por tipo
+    - Devuelve cuántas líneas se aceptaron y cuáles se rechazaron
+    """
+    return await importar_ndjson(request.stream())
+
+
+# Métricas del buffer de escritura diferida
+@router.get("/sensores/metricas/escritura")
+async def get_metricas_escritura():
+    return metricas_escritura()
+
+
+# Cola, eventos descartados y retraso de cada socket de /ws/sensores
+@router.get("/sensores/metricas/websocket")
+async def get_metricas_websocket():
+    return difusor.metricas()
+
+
+# Parámetros de paginación y formato comunes a los listados de sensores
+def parametros_listado(
+    limit: Optional[int] = Query(None, ge=1, le=LIMITE_PAGINA_MAXIMO),
+    after: Optional[str] = None,
+    orden: str = Query("_id", pattern="^(_id|fecha_hora)$"),
+    formato: str = Query("json", pattern="^(json|ndjson)$"),
+    fields: Optional[str] = Query(None, description="Campos separados por coma, p. ej. _id,ubicacion")
+):
+    return {"limit": limit, "after": after, "orden": orden, "formato": formato, "fields": fields}
+
+
+# Filtros de los listados; cada combinación está cubierta por un índice (ver almacenamiento.INDICES_LECTURAS)
+def filtros_listado(
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    sensor_id: Optional[str] = None,
+    ubicacion: Optional[str] = None,
+    estado: Optional[str] = None
+) -> dict:
+    return filtro_lecturas(desde, hasta, sensor_id, ubicacion, estado)
+
+
+def codificar_cursor(orden: str, documento: dict) -> str:
+    """Cursor opaco con la posición del último documento devuelto."""
+    posicion = {"o": orden, "id": str(documento["_id"])}
+    if orden == "fecha_hora":
+        posicion["v"] = documento["fecha_hora"].isoformat()
+    return base64.urlsafe_b64encode(json.dumps(posicion).encode()).decode()
+
+
+def filtro_despues_de(cursor: str, orden: str) -> dict:
+    """Convierte un cursor en el filtro que continúa justo después de esa posición."""
+    try:
+        posicion = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        ultimo_id = ObjectId(posicion["id"])
+        if posicion["o"] != orden:
+            raise ValueError("El cursor corresponde a otro orden")
+        if orden == "_id":
+            return {"_id": {"$gt": ultimo_id}}
+        ultima_fecha = datetime.fromisoformat(posicion["v"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Cursor inválido: {str(e)}")
+    # fecha_hora puede repetirse, el _id desempata
+    return {"$or": [
+        {"fecha_hora": {"$gt": ultima_fecha}},
+        {"fecha_hora": ultima_fecha, "_id": {"$gt": ultimo_id}},
+    ]}
+
+
+# Función genérica para obtener todos los sensores de un tipo
+async def get_all_sensors(tipo, parametros: dict = None, filtro: dict = None):
+    """
+    - Sin `limit` devuelve todos los documentos como un arreglo JSON que se envía
+      conforme el cursor de Mongo los entrega, sin juntarlos en memoria
+    - Con `limit` devuelve una página {"data": [...], "siguiente": cursor}; el
+      cursor se pasa en `after` para pedir la página siguiente
+    - Con formato=ndjson envía un documento por línea; si la página se llenó, la
+      última línea es {"siguiente": cursor}
+    - Con `fields` solo se leen de Mongo esos campos (más _id y la clave de orden)
+    """
+    parametros = parametros or parametros_listado(None, None, "_id", "json", None)
+    orden, limite = parametros["orden"], parametros["limit"]
+    campos = campos_solicitados(parametros["fields"], CAMPOS_LECTURA[tipo])
+    if campos is not None and orden not in campos:
+        # El cursor de la página siguiente se arma con la clave de orden
+        campos.append(orden)
+    filtro = dict(filtro or {})
+    if orden == "fecha_hora":
+        # Los registros de sensores y los documentos del Arduino no tienen fecha_hora, así que no tienen
+        # posición en este orden (y no se podría armar el cursor con ellos)
+        filtro["fecha_hora"] = {**filtro.get("fecha_hora", {}), "$type": "date"}
+    if parametros["after"]:
+        # El cursor (_id o $or) va junto a las claves del filtro, no envuelto en $and: así el modo
+        # timeseries sigue pasando sensor_id/ubicacion a meta.* y el modo buckets los usa para
+        # descartar buckets antes del $unwind
+        filtro.update(filtro_despues_de(parametros["after"], orden))
+    claves_orden = [("_id", 1)] if orden == "_id" else [("fecha_hora", 1), ("_id", 1)]
+    lecturas = consultar_lecturas(tipo, filtro, orden=claves_orden, limite=limite, proyeccion=proyeccion(campos))
+
+    if limite and parametros["formato"] == "json":
+        sensors = [sensor async for sensor in lecturas]
+        siguiente = codificar_cursor(orden, sensors[-1]) if len(sensors) == limite else None
+        return RespuestaJSON({"data": sensors, "siguiente": siguiente})
+
+    if parametros["formato"] == "ndjson":
+        async def generar_ndjson():
+            enviados, ultimo = 0, None
+            async for sensor in lecturas:
+                enviados, ultimo = enviados + 1, sensor
+                yield a_texto(sensor) + "\n"
+            if limite and enviados == limite:
+                yield json.dumps({"siguiente": codificar_cursor(orden, ultimo)}) + "\n"
+        return StreamingResponse(generar_ndjson(), media_type="application/x-ndjson")
+
+    return StreamingResponse(arreglo_json(lecturas), media_type="application/json")
+
+
+async def arreglo_json(documentos):
+    """Arreglo JSON que se envía conforme llegan los documentos, sin juntarlos en memoria."""
+    separador = "["
+    async for documento in documentos:
+        yield separador + a_texto(documento)
+        separador = ","
+    yield "[]" if separador == "[" else "]"
 
 
 # Rutas para obtener todos los sensores en cada colección
 @router.get("/sensores/movimiento/")
-async def get_sensores_movimiento():
-    return await get_all_sensors(collection_movimiento)
+async def get_sensores_movimiento(parametros: dict = Depends(parametros_listado),
+                                  filtro: dict = Depends(filtros_listado)):
+    return await get_all_sensors("movimiento", parametros, filtro)
 
 
 @router.get("/sensores/humo/")
-async def get_sensores_humo():
-    return await get_all_sensors(collection_humo)
+async def get_sensores_humo(parametros: dict = Depends(parametros_listado),
+                            filtro: dict = Depends(filtros_listado)):
+    return await get_all_sensors("humo", parametros, filtro)
 
 
 @router.get("/sensores/magnetico/")
-async def get_sensores_deteccion():
-    return await get_all_sensors(collection_magnetico)
+async def get_sensores_deteccion(parametros: dict = Depends(parametros_listado),
+                                 filtro: dict = Depends(filtros_listado)):
+    return await get_all_sensors("magnetico", parametros, filtro)
 
 @router.get("/sensores/sonido/")
-async def get_sensores_sonido():
-    return await get_all_sensors(collection_sonido)
+async def get_sensores_sonido(parametros: dict = Depends(parametros_listado),
+                              filtro: dict = Depends(filtros_listado)):
+    return await get_all_sensors("sonido", parametros, filtro)
 
 @router.get("/sensores/gas/")
-async def get_sensores_gas():
-    return await get_all_sensors(collection_gas)
-
-# Ruta genérica para actualizar un sensor en una colección
-async def update_sensor(sensor_id: str, sensor_data, collection):
-    result = await collection.update_one({"_id": ObjectId(sensor_id)}, {"$set": sensor_data})
+async def get_sensores_gas(parametros: dict = Depends(parametros_listado),
+                           filtro: dict = Depends(filtros_listado)):
+    return await get_all_sensors("gas", parametros, filtro)
+
+# Serie preagregada (mínimo, máximo, promedio, cantidad y último valor) de un sensor
+@router.get("/sensores/{tipo}/rollups")
+async def get_rollups_sensor(
+    tipo: str,
+    sensor_id: str,
+    resolucion: str = Query("hora", pattern="^(minuto|hora|dia)$"),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    limite: int = Query(1000, ge=1, le=10000)
+):
+    if tipo not in SENSORES:
+        raise HTTPException(status_code=404, detail="Tipo de sensor no válido")
+    serie = await rollups.consultar(tipo, sensor_id, resolucion, desde, hasta, limite)
+    return {"tipo": tipo, "sensor_id": sensor_id, "resolucion": resolucion, "serie": serie}
+
+
+# Lecturas de un tipo en un rango de fechas, incluidas las que ya pasaron al archivo local
+@router.get("/sensores/{tipo}/historico")
+async def get_historico_sensor(
+    tipo: str,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    sensor_id: Optional[str] = None
+):
+    if tipo not in SENSORES:
+        raise HTTPException(status_code=404, detail="Tipo de sensor no válido")
+
+    filtro = filtro_lecturas(desde, hasta, sensor_id)
+    # Archivo y Mongo pueden sumar muchas lecturas: se envían conforme se leen
+    return StreamingResponse(arreglo_json(consultar_historico(tipo, filtro)), media_type="application/json")
+
+
+# Las listas de sensores de las casas muestran el registro (ubicación, si existe): se invalida su ETag y su caché
+async def sensor_modificado(sensor_obj_id: ObjectId):
+    for casa_id in await subir_version_sensores_de(sensor_obj_id):
+        await estado_actual.cargar_casa(str(casa_id))
+
+
+# Ruta genérica para actualizar un sensor en la colección de su tipo
+async def update_sensor(sensor_id: str, sensor_data, tipo):
+    result = await coleccion_sensores(tipo).update_one(filtro_tipo(tipo, {"_id": ObjectId(sensor_id)}), {"$set": sensor_data})
     if result.modified_count:
+        await sensor_modificado(ObjectId(sensor_id))
+        return {**sensor_data, "id": sensor_id}
+    # En timeseries y buckets los ids que devuelve POST /sensor/<tipo>/ son de lecturas, que están en otra colección
+    if MODO_ALMACENAMIENTO != "documentos" and await actualizar_lectura(tipo, ObjectId(sensor_id), sensor_data):
         return {**sensor_data, "id": sensor_id}
-    else:
-        raise HTTPException(status_code=404, detail="Sensor no encontrado")
+    raise HTTPException(status_code=404, detail="Sensor no encontrado")
 
 
 # Ejemplo de ruta para actualizar un sensor de movimiento
 @router.put("/sensor/movimiento/{sensor_id}")
 async def update_sensor_movimiento(sensor_id: str, sensor: SensorMovimiento):
-    return await update_sensor(sensor_id, sensor.dict(), collection_movimiento)
+    # Solo los campos que trae el cuerpo; los opcionales omitidos no deben quedar en null
+    return await update_sensor(sensor_id, sensor.dict(exclude_unset=True), "movimiento")
 
 
 # Ejemplo de ruta para eliminar un sensor de movimiento
 @router.delete("/sensor/movimiento/{sensor_id}")
 async def delete_sensor_movimiento(sensor_id: str):
-    result = await collection_movimiento.delete_one({"_id": ObjectId(sensor_id)})
+    result = await coleccion_sensores("movimiento").delete_one(filtro_tipo("movimiento", {"_id": ObjectId(sensor_id)}))
     if result.deleted_count:
+        await sensor_modificado(ObjectId(sensor_id))
+        return {"status": "Sensor eliminado"}
+    if MODO_ALMACENAMIENTO != "documentos" and await eliminar_lecturas("movimiento", [ObjectId(sensor_id)]):
         return {"status": "Sensor eliminado"}
-    else:
-        raise HTTPException(status_code=404, detail="Sensor no encontrado")
+    raise HTTPException(status_code=404, detail="Sensor no encontrado")
 
 
-# WebSocket para recibir cambios en todas las colecciones en tiempo real
+# WebSocket para recibir en tiempo real los cambios de las casas, tipos o sensores suscritos
 @router.websocket("/ws/sensores")
 async def websocket_endpoint(websocket: WebSocket):
+    """
+    El primer mensaje debe ser {"accion": "autenticar", "token": "<jwt>"}; puede
+    incluir "politica" (descartar_antiguos, combinar o desconectar) para elegir
+    qué pasa cuando el socket no alcanza a recibir los eventos a tiempo, y
+    "lote": {"espera_ms": 50, "eventos": 100} para recibir los eventos juntos
+    en un arreglo JSON por frame en vez de un frame por evento. Se responde con
+    {"accion": "autenticado", ...} y los valores que quedaron en uso.
+    Después, {"accion": "suscribir" | "desuscribir", "casas": [...],
+    "tipos": [...], "sensores": [...]} cambia lo que recibe el socket; se
+    responde con {"accion": "suscripciones", "instancia": ..., "seq": ...}
+    y lo que se haya rechazado.
+
+    Cada evento trae su `seq`. Al reconectarse, el cliente manda su suscripción
+    con "instancia" y "desde" (el último seq recibido) y primero recibe los
+    eventos que se perdió; si "perdidos" es true en la respuesta, parte de
+    ellos ya no estaba en el historial y conviene recargar el estado por HTTP.
+    Un cliente solo puede suscribirse a sus casas y a los sensores de ellas, y
+    sus `tipos` se limitan a sus casas; el admin puede suscribirse a cualquiera.
+    """
     await websocket.accept()
+    autenticacion = await autenticar_socket(websocket)
+    if autenticacion is None:
+        return
+    payload, politica, lote = autenticacion
+
+    # Los change streams los abre el difusor una sola vez; el socket solo lee de su cola
+    suscriptor = difusor.suscribir(politica)
+    enviar = asyncio.create_task(enviar_cambios(websocket, suscriptor, lote))
+    recibir = asyncio.create_task(recibir_suscripciones(websocket, suscriptor, payload))
     try:
-        collections = [collection_movimiento, collection_sonido, collection_magnetico, collection_gas, collection_sonido]
-        # Ejecuta todos los streams de forma concurrente
-        await asyncio.gather(*(stream_changes(websocket, col) for col in collections))
-    except Exception as e:
-        print(f"Error en WebSocket: {e}")
-        await websocket.close()
-
-async def stream_changes(websocket: WebSocket, collection):
-    async for change in collection.watch():
-        serialized_change = serialize_mongo_document(change)
-        await websocket.send_json(serialized_change)
-
-async def merge_streams(*streams):
-    for stream in streams:
-        try:
-            async for change in stream:
-                # Serializa el documento antes de enviarlo
-                change = serialize_mongo_document(change)
-                print(f"Evento de cambio recibido: {change}")  # Agrega este print para depuración
-                yield change
-        except Exception as e:
-            print("Error en el merge_streams:")
-            print(traceback.format_exc())  # Imprime la traza del error
-            continue
-
-def serialize_mongo_document(doc):
-    """Convierte los campos de MongoDB en tipos JSON serializables."""
-    if isinstance(doc, ObjectId):
-        return str(doc)
-    if isinstance(doc, datetime):
-        return doc.isoformat()  # Convierte el timestamp a una cadena ISO
-    if isinstance(doc, Timestamp):
-        return str(doc)  # Convierte Timestamp a cadena
-    if isinstance(doc, dict):
-        return {key: serialize_mongo_document(value) for key, value in doc.items()}
-    return doc
+        await asyncio.wait({enviar, recibir}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        difusor.desuscribir(suscriptor)
+        enviar.cancel()
+        recibir.cancel()
+        await asyncio.gather(enviar, recibir, return_exceptions=True)
+
+
+async def autenticar_socket(websocket: WebSocket) -> Optional[tuple]:
+    """
+    (payload del JWT, política de la cola, lote) del primer mensaje; `lote` es None
+    o (espera en segundos, eventos). Si no es válido cierra el socket y devuelve None.
+    """
+    try:
+        mensaje = json.loads(await asyncio.wait_for(websocket.receive_text(), ESPERA_AUTENTICACION))
+        if not isinstance(mensaje, dict) or mensaje.get("accion") != "autenticar":
+            raise ValueError("Se esperaba {\"accion\": \"autenticar\", \"token\": ...}")
+        politica = mensaje.get("politica", POLITICA)
+        if politica not in POLITICAS:
+            raise ValueError(f"Política no válida: {politica}. Disponibles: {', '.join(POLITICAS)}")
+        lote = opciones_lote(mensaje.get("lote"))
+        token = str(mensaje.get("token"))
+        await check_token_blacklist(token)
+        payload = decode_access_token(token)
+    except WebSocketDisconnect:
+        return None
+    except (asyncio.TimeoutError, ValueError, HTTPException) as e:
+        detalle = e.detail if isinstance(e, HTTPException) else str(e) or "Tiempo de autenticación agotado"
+        await websocket.send_json({"error": detalle})
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return None
+
+    await websocket.send_json({
+        "accion": "autenticado",
+        "politica": politica,
+        "lote": {"espera_ms": round(lote[0] * 1000), "eventos": lote[1]} if lote else None,
+    })
+    return payload, politica, lote
+
+
+def opciones_lote(lote) -> Optional[tuple]:
+    """Valida el "lote" pedido por el cliente y lo ajusta a los topes del servidor."""
+    if lote is None:
+        return None
+    if not isinstance(lote, dict):
+        raise ValueError("\"lote\" debe ser un objeto con espera_ms y eventos")
+    try:
+        espera_ms = int(lote.get("espera_ms", LOTE_ESPERA_MS))
+        eventos = int(lote.get("eventos", LOTE_EVENTOS))
+    except (TypeError, ValueError):
+        raise ValueError("espera_ms y eventos deben ser enteros")
+    return min(max(espera_ms, 1), LOTE_ESPERA_MAXIMA_MS) / 1000, min(max(eventos, 1), LOTE_EVENTOS_MAXIMO)
+
+
+def lista_de(mensaje: dict, campo: str) -> list:
+    valores = mensaje.get(campo)
+    return [str(valor) for valor in valores] if isinstance(valores, list) else []
+
+
+async def claves_permitidas(payload: dict, mensaje: dict) -> tuple:
+    """Traduce casas, tipos y sensores a claves del difusor; devuelve (claves, rechazadas)."""
+    es_admin = payload.get("rol") == "admin"
+    usuario_id = payload.get("id")
+    claves, rechazadas = [], []
+
+    for casa_id in lista_de(mensaje, "casas"):
+        casa = estado_actual.casas.get(casa_id) or await estado_actual.cargar_casa(casa_id)
+        if casa is not None and (es_admin or casa.usuario_id == usuario_id):
+            claves.append(clave_casa(casa_id))
+        else:
+            rechazadas.append({"casa": casa_id})
+
+    for tipo in lista_de(mensaje, "tipos"):
+        if tipo in SENSORES:
+            claves.append(clave_tipo(tipo, None if es_admin else usuario_id))
+        else:
+            rechazadas.append({"tipo": tipo})
+
+    for sensor_id in lista_de(mensaje, "sensores"):
+        propio = any(
+            estado_actual.casas[casa_id].usuario_id == usuario_id
+            for casa_id in estado_actual.casas_por_sensor.get(sensor_id, ())
+        )
+        if es_admin or propio:
+            claves.append(clave_sensor(sensor_id))
+        else:
+            rechazadas.append({"sensor": sensor_id})
+    return claves, rechazadas
+
+
+def describir_suscripciones(suscriptor) -> dict:
+    descripcion = {"casas": [], "tipos": [], "sensores": []}
+    for clave in suscriptor.claves:
+        descripcion[{"casa": "casas", "tipo": "tipos", "sensor": "sensores"}[clave[0]]].append(clave[1])
+    return descripcion
+
+
+async def recibir_suscripciones(websocket: WebSocket, suscriptor, payload: dict):
+    try:
+        while True:
+            try:
+                mensaje = json.loads(await websocket.receive_text())
+                accion = mensaje.get("accion")
+            except (ValueError, AttributeError):
+                await websocket.send_json({"error": "JSON inválido"})
+                continue
+            if accion not in ("suscribir", "desuscribir"):
+                await websocket.send_json({"error": f"Acción no válida: {accion}"})
+                continue
+
+            claves, rechazadas = await claves_permitidas(payload, mensaje)
+            respuesta = {"accion": "suscripciones"}
+            if accion == "suscribir":
+                difusor.agregar(suscriptor, claves)
+                # Sin await entre agregar y reanudar: lo reenviado queda en la cola antes que lo nuevo
+                if isinstance(mensaje.get("desde"), int):
+                    respuesta["reenviados"], respuesta["perdidos"] = difusor.reanudar(
+                        suscriptor, mensaje.get("instancia"), mensaje["desde"]
+                    )
+            else:
+                difusor.quitar(suscriptor, claves)
+            respuesta.update(describir_suscripciones(suscriptor), instancia=difusor.instancia, seq=difusor.seq)
+            if rechazadas:
+                respuesta["rechazadas"] = rechazadas
+            await websocket.send_json(respuesta)
+    except WebSocketDisconnect:
+        pass
+
+
+async def enviar_cambios(websocket: WebSocket, suscriptor, lote: Optional[tuple] = None):
+    while True:
+        await suscriptor.esperar()
+        if suscriptor.desbordado:
+            # Política "desconectar": el cliente puede reconectarse y reanudar desde su último seq
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Cola de eventos llena")
+            return
+        if lote is None:
+            eventos = [suscriptor.tomar()]
+            await websocket.send_text(eventos[0].serializado())
+        else:
+            eventos = await juntar_lote(suscriptor, *lote)
+            # Los eventos ya vienen serializados; el arreglo se arma sin volver a pasar por JSON
+            await websocket.send_text("[" + ",".join(evento.serializado() for evento in eventos) + "]")
+        suscriptor.enviado(eventos)
+
+
+async def juntar_lote(suscriptor, espera: float, maximo: int) -> list:
+    """Junta eventos hasta completar `maximo`, LOTE_BYTES_MAXIMO o `espera` segundos desde el primero."""
+    limite = time.monotonic() + espera
+    eventos, tamano = [], 0
+    while len(eventos) < maximo and tamano < LOTE_BYTES_MAXIMO:
+        if not suscriptor.pendientes:
+            restante = limite - time.monotonic()
+            if restante <= 0 or not await suscriptor.esperar(restante):
+                break
+        evento = suscriptor.tomar()
+        eventos.append(evento)
+        tamano += len(evento.serializado())
+    return eventos
+
+
+# WebSocket para que los dispositivos envíen lecturas por una conexión persistente
+@router.websocket("/ws/dispositivos")
+async def websocket_dispositivos(websocket: WebSocket):
+    """
+    Cada mensaje puede ser una lectura, una lista de lecturas o
+    {"seq": n, "lecturas": [...]}. Por cada mensaje se responde
+    {"seq": n, "insertadas": ..., "fallidas": ..., "errores": [...]}; si el
+    dispositivo no envía `seq` se usa un contador de la conexión.
+    """
+    await websocket.accept()
+    seq_local = 0
+    try:
+        while True:
+            mensaje = await websocket.receive_text()
+            seq_local += 1
+            try:
+                contenido = json.loads(mensaje)
+            except ValueError:
+                await websocket.send_json({"seq": seq_local, "error": "JSON inválido"})
+                continue
+
+            seq = seq_local
+            if isinstance(contenido, dict) and "lecturas" in contenido:
+                seq = contenido.get("seq", seq_local)
+                contenido = contenido["lecturas"]
+            elif isinstance(contenido, dict) and "seq" in contenido:
+                seq = contenido.pop("seq")
+
+            await websocket.send_json({"seq": seq, **await guardar_mensaje_dispositivo(contenido)})
+    except WebSocketDisconnect:
+        pass
+
+
+async def guardar_mensaje_dispositivo(contenido):
+    """Guarda una lectura o lista de lecturas por el mismo camino que las rutas POST."""
+    if isinstance(contenido, list):
+        if len(contenido) > LOTE_MAXIMO:
+            return {"insertadas": 0, "fallidas": len(contenido),
+                    "errores": [{"error": f"El lote excede el máximo de {LOTE_MAXIMO} lecturas"}]}
+        resultados = await insertar_lecturas(contenido)
+        errores = [resultado for resultado in resultados if not resultado["ok"]]
+        return {"insertadas": len(resultados) - len(errores), "fallidas": len(errores), "errores": errores}
 
+    try:
+        tipo, documento = validar_lectura(contenido)
+        inserted_id = await guardar_lectura(tipo, documento)
+    except (LecturaInvalida, PyMongoError) as e:
+        return {"insertadas": 0, "fallidas": 1, "errores": [{"indice": 0, "ok": False, "error": str(e)}]}
+    return {"insertadas": 1, "fallidas": 0, "errores": [], "id": str(inserted_id)}
@@ -1,22 +1,33 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from bson import ObjectId
 from fastapi import APIRouter
-from fastapi import HTTPException, Depends, status
+from fastapi import HTTPException, Depends, status, Request, Query
+from fastapi.responses import StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordRequestForm
 
-from Routes.cliente import convert_objectid
+from Routes.cliente import convert_objectid, CAMPOS_CASA
 from enviar_email import enviar_correo_bienvenida
 from auth import get_current_user, oauth2_scheme, create_access_token, generar_contraseña_aleatoria, \
     encriptar_contraseña, verificar_contraseña, token_blacklist
-from Modelos.models import collection_gas, collection_humo, collection_magnetico, collection_movimiento, collection_sonido
-from Modelos.user_models import Cliente, Casa, SensorRequest, TokenResponse, CasaInfo
+from Modelos.models import SENSORES
+import estado_actual
+from almacenamiento import crear_sensor
+from sensores_casa import resolver_sensores
+from exportacion import FORMATOS, sensores_a_exportar, bloques_de_lecturas, exportar
+from serializacion import RespuestaJSON, campos_solicitados, proyeccion
+from versiones import etag, coincide, no_modificado, encabezados, version_casas, SUBIR_VERSION_CASAS, \
+    SUBIR_VERSION_SENSORES, VERSION_SENSORES
+from Modelos.user_models import Cliente, ClienteResumen, Casa, SensorRequest, TokenResponse, CasaInfo
 from Modelos.user_models import collection_cliente, collection_casa
 
 router = APIRouter()
 
+# Campos que se pueden pedir con fields= en /admin/clientes (la contraseña nunca se envía)
+CAMPOS_CLIENTE = ("_id", "nombre", "correo", "rol", "casas")
+
 
 # Login (ruta /login)
 @router.post("/login", response_model=TokenResponse)
@@ -122,28 +133,31 @@ async def create_cliente(
         )       
 #Ruta para traer la información básica de todos los clientes
 
-@router.get("/admin/clientes", response_model=List[Cliente])
-async def get_clientes():
+@router.get("/admin/clientes", response_model=List[ClienteResumen])
+async def get_clientes(fields: Optional[str] = None):
+    campos = campos_solicitados(fields, CAMPOS_CLIENTE)
     try:
-        # Obtiene solo los clientes con rol "cliente"
-        clientes = await collection_cliente.find({"rol": "cliente"}).to_list(length=None)
+        # Obtiene solo los clientes con rol "cliente", sin la contraseña; con fields= solo esos campos
+        cursor = collection_cliente.find({"rol": "cliente"}, proyeccion(campos or CAMPOS_CLIENTE))
+        clientes = await cursor.to_list(length=None)
 
         for cliente in clientes:
             # Si el cliente tiene casas, aseguramos que tengan el formato esperado
-            casas = cliente.get("casas", [])
-            cliente["casas"] = [
-                {
-                    "id": str(casa["_id"]) if isinstance(casa.get("_id"), ObjectId) else casa.get("id", ""),
-                    "nombre": casa.get("nombre", "Sin nombre")
-                }
-                for casa in casas if isinstance(casa, dict)
-            ]
-
-            # Eliminamos la contraseña antes de devolver la información
-            cliente.pop("contraseña", None)
-
-        # Devolvemos los clientes con la información correcta de casas
-        return [Cliente(**cliente) for cliente in clientes]
+            if "casas" in cliente:
+                cliente["casas"] = [
+                    {
+                        "id": str(casa["_id"]) if isinstance(casa.get("_id"), ObjectId) else casa.get("id", ""),
+                        "nombre": casa.get("nombre", "Sin nombre")
+                    }
+                    for casa in cliente["casas"] if isinstance(casa, dict)
+                ]
+            if campos is None:
+                cliente.setdefault("nombre", None)
+                cliente.setdefault("casas", [])
+                cliente["contraseña"] = None
+
+        # Los documentos ya tienen la forma de Cliente; se serializan sin volver a validarlos
+        return RespuestaJSON(clientes)
 
     except Exception as e:
         raise HTTPException(
@@ -198,8 +212,9 @@ async def agregar_casa_a_cliente(
         # Actualizar el cliente para agregar el objeto de la casa con id y nombre
         await collection_cliente.update_one(
             {"_id": ObjectId(cliente_id)},
-            {"$push": {"casas": casa_objeto}}  # Guardar el objeto de la casa (id y nombre)
+            {"$push": {"casas": casa_objeto}, **SUBIR_VERSION_CASAS}  # Guardar el objeto de la casa (id y nombre)
         )
+        await estado_actual.cargar_casa(str(nueva_casa["_id"]))
 
         # Devolver la casa creada como respuesta, incluyendo el nombre
         return Casa(**nueva_casa)
@@ -212,7 +227,12 @@ async def agregar_casa_a_cliente(
         
 #Endpoint para ver las casas de los clientes
 @router.get("/admin/clientes/{cliente_id}/casas")
-async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_scheme)):
+async def get_casas_de_cliente(
+        cliente_id: str,
+        request: Request,
+        token: str = Depends(oauth2_scheme),
+        fields: Optional[str] = None
+):
     try:
         # Validar el token y obtener el usuario actual
         current_user = await get_current_user(token)
@@ -224,14 +244,22 @@ async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_sche
                 detail="No tienes permiso para acceder a estas casas"
             )
 
+        # Si la app ya tiene esta versión de las casas no se vuelven a consultar
+        etiqueta = etag("casas", cliente_id, await version_casas(cliente_id), fields)
+        if coincide(request, etiqueta):
+            return no_modificado(etiqueta)
+
         # Buscar todas las casas asociadas al cliente
-        casas = await collection_casa.find({"usuario_id": ObjectId(cliente_id)}).to_list(length=None)
+        campos = campos_solicitados(fields, CAMPOS_CASA) or CAMPOS_CASA
+        casas = await collection_casa.find(
+            {"usuario_id": ObjectId(cliente_id)}, proyeccion(campos, {"id": "_id"})
+        ).to_list(length=None)
 
         # Convertir los ObjectId a string para asegurar la serialización correcta
-        casas_serializable = convert_objectid(casas)
+        casas_serializable = convert_objectid(casas, campos)
 
         # Ajuste de la estructura de la respuesta
-        return {"data": casas_serializable}
+        return RespuestaJSON({"data": casas_serializable}, headers=encabezados(etiqueta))
 
     except HTTPException as he:
         raise he
@@ -265,34 +293,26 @@ async def agregar_sensor_a_casa(
         if not casa:
             raise HTTPException(status_code=404, detail="Casa no encontrada o no pertenece al usuario")
 
-        # Determinar la colección de sensores según el tipo
+        # Validar el tipo de sensor
         tipo_sensor = sensor_request.tipo_sensor
-        sensor_collection = None
-        if tipo_sensor == "gas":
-            sensor_collection = collection_gas
-        elif tipo_sensor == "humo":
-            sensor_collection = collection_humo
-        elif tipo_sensor == "movimiento":
-            sensor_collection = collection_movimiento
-        elif tipo_sensor == "sonido":
-            sensor_collection = collection_sonido
-        elif tipo_sensor == "magnetico":
-            sensor_collection = collection_magnetico
-        else:
+        if tipo_sensor not in SENSORES:
             raise HTTPException(status_code=400, detail="Tipo de sensor no válido")
 
         # Insertar el sensor en la colección correspondiente
         sensor_data = sensor_request.sensor_data
         #sensor_data["_id"] = tipo_sensor  # Agrega el id
         sensor_data["nombre"] = tipo_sensor  # AAgrega el nombre
-        nuevo_sensor = await sensor_collection.insert_one(sensor_data)
+        sensor_obj_id = await crear_sensor(tipo_sensor, sensor_data)
 
         # Actualizar la casa con la referencia al sensor
-        sensor_obj_id = nuevo_sensor.inserted_id
         await collection_casa.update_one(
             {"_id": ObjectId(casa_id)},
-            {"$push": {"sensores": {"sensor_obj_id": sensor_obj_id, "sensor_tipo": tipo_sensor}}}
+            {
+                "$push": {"sensores": {"sensor_obj_id": sensor_obj_id, "sensor_tipo": tipo_sensor}},
+                **SUBIR_VERSION_SENSORES  # Las apps que ya tenían la lista la vuelven a pedir
+            }
         )
+        await estado_actual.cargar_casa(casa_id)
 
         return {"message": "Sensor agregado exitosamente", "sensor_id": str(sensor_obj_id)}
 
@@ -304,11 +324,43 @@ async def agregar_sensor_a_casa(
             detail=f"Error al agregar el sensor a la casa: {str(e)}"
         )
 
+# Exporta en streaming las lecturas de una casa o de un sensor en un rango de fechas
+@router.get("/exportar/lecturas")
+async def exportar_lecturas(
+    casa_id: Optional[str] = None,
+    sensor_id: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    formato: str = Query("csv", pattern="^(csv|parquet)$"),
+    current_user: Cliente = Depends(get_current_user)
+):
+    if not casa_id and not sensor_id:
+        raise HTTPException(status_code=400, detail="Indica casa_id o sensor_id")
+
+    casa = None
+    if casa_id:
+        casa = await estado_actual.cargar_casa(casa_id)
+        if casa is None:
+            raise HTTPException(status_code=404, detail="Casa no encontrada")
+    # Un cliente solo puede exportar sus propias casas; el admin puede exportar cualquier sensor
+    if current_user.rol != "admin" and (casa is None or casa.usuario_id != str(current_user.id)):
+        raise HTTPException(status_code=403, detail="No tienes permiso para exportar estas lecturas")
+
+    por_tipo = sensores_a_exportar(casa, sensor_id)
+    nombre = f"lecturas_{casa_id or sensor_id}.{formato}"
+    return StreamingResponse(
+        exportar(formato, bloques_de_lecturas(por_tipo, desde, hasta)),
+        media_type=FORMATOS[formato],
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'}
+    )
+
+
 # Endpoint para ver los sensores
 @router.get("/admin/clientes/{usuario_id}/casas/{casa_id}/sensores")
 async def obtener_sensores_de_casa(
     usuario_id: str,
     casa_id: str,
+    request: Request,
     token: str = Depends(oauth2_scheme)
 ):
     try:
@@ -323,44 +375,23 @@ async def obtener_sensores_de_casa(
             )
 
         # Verificar que la casa existe y pertenece al usuario
-        casa = await collection_casa.find_one({"_id": ObjectId(casa_id), "usuario_id": ObjectId(usuario_id)})
+        casa = await collection_casa.find_one(
+            {"_id": ObjectId(casa_id), "usuario_id": ObjectId(usuario_id)}, {"sensores": 1, VERSION_SENSORES: 1}
+        )
         if not casa:
             raise HTTPException(status_code=404, detail="Casa no encontrada o no pertenece al usuario")
 
+        # Si la app ya tiene esta versión de la lista no se resuelven los sensores
+        etiqueta = etag("sensores", casa_id, casa.get(VERSION_SENSORES, 0))
+        if coincide(request, etiqueta):
+            return no_modificado(etiqueta)
+
         # Obtener los sensores de la casa
-        sensores_referencias = casa.get("sensores", [])
-        sensores_detallados = []
-
-        for sensor_ref in sensores_referencias:
-            sensor_obj_id = sensor_ref.get("sensor_obj_id")
-            sensor_tipo = sensor_ref.get("sensor_tipo")
-
-            if not sensor_obj_id or not sensor_tipo:
-                continue  # Saltar si la referencia no es válida
-
-            sensor_info = None
-            if sensor_tipo == "gas":
-                sensor_info = await collection_gas.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "humo":
-                sensor_info = await collection_humo.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "movimiento":
-                sensor_info = await collection_movimiento.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "sonido":
-                sensor_info = await collection_sonido.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "magnetico":
-                sensor_info = await collection_magnetico.find_one({"_id": ObjectId(sensor_obj_id)})
-
-            if sensor_info:
-                # Formatear los datos del sensor para la respuesta
-                sensor_serializable = {
-                    "_id": str(sensor_info["_id"]),
-                    "tipo": sensor_tipo,
-                    "ubicacion": sensor_info.get("ubicacion", ""),
-                    # Otros campos específicos del sensor según su tipo
-                }
-                sensores_detallados.append(sensor_serializable)
+        sensores_detallados = await resolver_sensores(casa.get("sensores", []))
 
-        return {"message": "Sensores obtenidos con éxito", "data": sensores_detallados}
+        return RespuestaJSON(
+            {"message": "Sensores obtenidos con éxito", "data": sensores_detallados}, headers=encabezados(etiqueta)
+        )
 
     except HTTPException as he:
         raise he
@@ -453,7 +484,7 @@ async def create_cliente_completo(
             # Crear sensores y asociarlos a la casa
             for sensor in sensores:
                 tipo_sensor = sensor.get("tipo_sensor")
-                if tipo_sensor not in ["gas", "humo", "movimiento", "sonido", "magnetico"]:
+                if tipo_sensor not in SENSORES:
                     raise HTTPException(
                         status_code=status.HTTP_400_BAD_REQUEST,
                         detail=f"Tipo de sensor no válido: {tipo_sensor}"
@@ -466,27 +497,22 @@ async def create_cliente_completo(
                     "tipo": tipo_sensor
                 }
 
-                sensor_collection = {
-                    "gas": collection_gas,
-                    "humo": collection_humo,
-                    "movimiento": collection_movimiento,
-                    "sonido": collection_sonido,
-                    "magnetico": collection_magnetico,
-                }[tipo_sensor]
-
-                sensor_result = await sensor_collection.insert_one(sensor_data)
-                sensor_id = sensor_result.inserted_id
+                sensor_id = await crear_sensor(tipo_sensor, sensor_data)
                 await collection_casa.update_one(
                     {"_id": casa_id},
-                    {"$push": {"sensores": {"sensor_obj_id": sensor_id, "sensor_tipo": tipo_sensor}}}
+                    {
+                        "$push": {"sensores": {"sensor_obj_id": sensor_id, "sensor_tipo": tipo_sensor}},
+                        **SUBIR_VERSION_SENSORES
+                    }
                 )
 
             # Asociar casa al cliente
             casa_info = {"id": str(casa_id), "nombre": casa["nombre"]}
             await collection_cliente.update_one(
                 {"_id": cliente_id},
-                {"$push": {"casas": casa_info}}
+                {"$push": {"casas": casa_info}, **SUBIR_VERSION_CASAS}
             )
+            await estado_actual.cargar_casa(str(casa_id))
 
         # Devolver el cliente creado
         created_cliente = await collection_cliente.find_one({"_id": cliente_id})
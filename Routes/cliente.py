@@ -1,10 +1,17 @@
 from bson import ObjectId
 from fastapi import APIRouter
-from fastapi import HTTPException, Depends, status, Query
-from typing import List
-from auth import get_current_user, oauth2_scheme, encriptar_contraseña, generar_contraseña_aleatoria
-from Modelos.models import collection_gas, collection_humo, collection_magnetico, collection_movimiento, collection_sonido
-from Modelos.user_models import Cliente, CambiarContraseñaRequest, CasaInfo, CasaInfo1, RecuperarContraseñaRequest
+from fastapi import HTTPException, Depends, status, Query, Request
+from datetime import datetime, timedelta
+from typing import List, Optional
+import estado_actual
+from auth import get_current_user, oauth2_scheme, encriptar_contraseña, generar_contraseña_aleatoria, \
+    decode_access_token, check_token_blacklist
+from Modelos.models import SENSORES
+from almacenamiento import pipeline_todos_los_tipos, coleccion_sensores, filtro_tipo, lookup_ultima_lectura
+from sensores_casa import resolver_sensores
+from serializacion import RespuestaJSON, campos_solicitados, proyeccion
+from versiones import etag, coincide, no_modificado, encabezados, version_casas, VERSION_SENSORES
+from Modelos.user_models import Cliente, CambiarContraseñaRequest, RecuperarContraseñaRequest
 from Modelos.user_models import collection_cliente, collection_casa
 from enviar_email import enviar_correo_recuperacion
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -30,30 +37,31 @@ async def actualizar_contraseña(
 
 
 
+# Campos que se pueden pedir con fields= en los listados de casas
+CAMPOS_CASA = ("id", "nombre")
+CAMPOS_CASA_DIRECCION = ("id", "nombre", "direccion")
+
+
 # Función para convertir ObjectId a str
-def convert_objectid(casas: List[dict]) -> List[CasaInfo]:
-    """Convierte todos los ObjectIds dentro de un objeto o lista a strings y crea instancias de CasaInfo."""
-    return [
-        CasaInfo(
-            id=str(casa["_id"]),
-            nombre=casa["nombre"]
-        ) for casa in casas
-    ]
-    
-    # Función para convertir ObjectId a str
-def convert1_objectid(casas: List[dict]) -> List[CasaInfo1]:
-    """Convierte todos los ObjectIds dentro de un objeto o lista a strings y crea instancias de CasaInfo."""
-    return [
-        CasaInfo1(
-            id=str(casa["_id"]),
-            nombre=casa["nombre"],
-            direccion=casa["direccion"]
-        ) for casa in casas
-    ]
-    
+def convert_objectid(casas: List[dict], campos=CAMPOS_CASA) -> List[dict]:
+    """Deja cada casa con la forma de CasaInfo (id y nombre), o solo con los `campos` pedidos."""
+    return [{campo: str(casa["_id"]) if campo == "id" else casa[campo] for campo in campos} for casa in casas]
+
+
+# Función para convertir ObjectId a str
+def convert1_objectid(casas: List[dict], campos=CAMPOS_CASA_DIRECCION) -> List[dict]:
+    """Deja cada casa con la forma de CasaInfo1 (id, nombre y dirección), o solo con los `campos` pedidos."""
+    return convert_objectid(casas, campos)
+
+
 # Endpoint para obtener solamente las casas y su ID
 @router.get("/clientes/{cliente_id}/casas")
-async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_scheme)):
+async def get_casas_de_cliente(
+        cliente_id: str,
+        request: Request,
+        token: str = Depends(oauth2_scheme),
+        fields: Optional[str] = None
+):
     try:
         # Validar el token y obtener el usuario actual
         current_user = await get_current_user(token)
@@ -65,14 +73,22 @@ async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_sche
                 detail="No tienes permiso para acceder a estas casas"
             )
 
+        # Si la app ya tiene esta versión de las casas no se vuelven a consultar
+        etiqueta = etag("casas", cliente_id, await version_casas(cliente_id), fields)
+        if coincide(request, etiqueta):
+            return no_modificado(etiqueta)
+
         # Buscar todas las casas asociadas al cliente
-        casas = await collection_casa.find({"usuario_id": ObjectId(cliente_id)}).to_list(length=None)
+        campos = campos_solicitados(fields, CAMPOS_CASA) or CAMPOS_CASA
+        casas = await collection_casa.find(
+            {"usuario_id": ObjectId(cliente_id)}, proyeccion(campos, {"id": "_id"})
+        ).to_list(length=None)
 
-        # Convertir los ObjectId a string y crear instancias de CasaInfo
-        casas_serializable = convert_objectid(casas)
+        # Convertir los ObjectId a string con la forma de CasaInfo
+        casas_serializable = convert_objectid(casas, campos)
 
         # Ajuste de la estructura de la respuesta
-        return {"data": casas_serializable}
+        return RespuestaJSON({"data": casas_serializable}, headers=encabezados(etiqueta))
 
     except HTTPException as he:
         raise he
@@ -84,7 +100,12 @@ async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_sche
 
 # Endpoint para obtener solamente las casas y su ID
 @router.get("/clientes/{cliente_id}/casas-direccion")
-async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_scheme)):
+async def get_casas_de_cliente(
+        cliente_id: str,
+        request: Request,
+        token: str = Depends(oauth2_scheme),
+        fields: Optional[str] = None
+):
     try:
         # Validar el token y obtener el usuario actual
         current_user = await get_current_user(token)
@@ -96,14 +117,22 @@ async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_sche
                 detail="No tienes permiso para acceder a estas casas"
             )
 
+        # Si la app ya tiene esta versión de las casas no se vuelven a consultar
+        etiqueta = etag("casas-direccion", cliente_id, await version_casas(cliente_id), fields)
+        if coincide(request, etiqueta):
+            return no_modificado(etiqueta)
+
         # Buscar todas las casas asociadas al cliente
-        casas = await collection_casa.find({"usuario_id": ObjectId(cliente_id)}).to_list(length=None)
+        campos = campos_solicitados(fields, CAMPOS_CASA_DIRECCION) or CAMPOS_CASA_DIRECCION
+        casas = await collection_casa.find(
+            {"usuario_id": ObjectId(cliente_id)}, proyeccion(campos, {"id": "_id"})
+        ).to_list(length=None)
 
-        # Convertir los ObjectId a string y crear instancias de CasaInfo
-        casas_serializable = convert1_objectid(casas)
+        # Convertir los ObjectId a string con la forma de CasaInfo1
+        casas_serializable = convert1_objectid(casas, campos)
 
         # Ajuste de la estructura de la respuesta
-        return {"data": casas_serializable}
+        return RespuestaJSON({"data": casas_serializable}, headers=encabezados(etiqueta))
 
     except HTTPException as he:
         raise he
@@ -114,6 +143,75 @@ async def get_casas_de_cliente(cliente_id: str, token: str = Depends(oauth2_sche
         )
 
 
+# Casas del cliente con sus sensores y la última lectura de cada uno, en una sola agregación
+@router.get("/clientes/{cliente_id}/dashboard")
+async def get_dashboard_cliente(cliente_id: str, token: str = Depends(oauth2_scheme)):
+    # Los permisos salen del token para no sumar otra consulta a Mongo
+    await check_token_blacklist(token)
+    payload = decode_access_token(token)
+    if payload.get("id") != cliente_id and payload.get("rol") != "admin":
+        raise HTTPException(status_code=403, detail="No tienes permiso para acceder a estas casas")
+    if not ObjectId.is_valid(cliente_id):
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+
+    try:
+        pipeline = [
+            {"$match": {"usuario_id": ObjectId(cliente_id)}},
+            {"$project": {"nombre": 1, "direccion": 1, "sensores": 1}},
+        ]
+        # Un $lookup por tipo: registros de los sensores de la casa y, dentro, su última lectura.
+        # La correlación va por localField/foreignField para que cada casa busque por el índice de _id
+        # (un $in dentro de $expr recorrería la colección entera, que en modo documentos tiene las lecturas)
+        for tipo in SENSORES:
+            pipeline.append({"$lookup": {
+                "from": coleccion_sensores(tipo).name,
+                "localField": "sensores.sensor_obj_id",
+                "foreignField": "_id",
+                "pipeline": [
+                    {"$match": filtro_tipo(tipo)},
+                    {"$project": {"ubicacion": 1, "sensor_id": {"$ifNull": ["$sensor_id", {"$toString": "$_id"}]}}},
+                    lookup_ultima_lectura(tipo, "$sensor_id", "ultima"),
+                    {"$set": {"ultima_lectura": {"$first": "$ultima"}}},
+                    {"$unset": "ultima"},
+                ],
+                "as": f"sensores_{tipo}",
+            }})
+
+        casas = []
+        async for casa in collection_casa.aggregate(pipeline):
+            encontrados = {
+                (tipo, sensor["_id"]): sensor
+                for tipo in SENSORES for sensor in casa.pop(f"sensores_{tipo}")
+            }
+            # Mismo orden en que los sensores se agregaron a la casa
+            sensores = []
+            for referencia in casa.get("sensores", []):
+                sensor = encontrados.get((referencia.get("sensor_tipo"), referencia.get("sensor_obj_id")))
+                if sensor is None:
+                    continue
+                sensores.append({
+                    "_id": str(sensor["_id"]),
+                    "tipo": referencia["sensor_tipo"],
+                    "sensor_id": sensor["sensor_id"],
+                    "ubicacion": sensor.get("ubicacion", ""),
+                    "ultima_lectura": sensor.get("ultima_lectura"),
+                })
+            casas.append({
+                "id": str(casa["_id"]),
+                "nombre": casa.get("nombre"),
+                "direccion": casa.get("direccion"),
+                "sensores": sensores,
+            })
+
+        return RespuestaJSON({"cliente_id": cliente_id, "casas": casas})
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al obtener el dashboard: {str(e)}"
+        )
+
+
 # En cliente.py
 
 # Endpoint para obtener la información básica del cliente
@@ -206,6 +304,7 @@ async def obtener_sensores_de_casa_especifica(
     
         usuario_id: str,
         casa_id: str,
+        request: Request,
         current_user: Cliente = Depends(get_current_user)
 ):
     try:
@@ -217,44 +316,23 @@ async def obtener_sensores_de_casa_especifica(
             )
 
         # Verificar que la casa existe y pertenece al usuario
-        casa = await collection_casa.find_one({"_id": ObjectId(casa_id), "usuario_id": ObjectId(usuario_id)})
+        casa = await collection_casa.find_one(
+            {"_id": ObjectId(casa_id), "usuario_id": ObjectId(usuario_id)}, {"sensores": 1, VERSION_SENSORES: 1}
+        )
         if not casa:
             raise HTTPException(status_code=404, detail="Casa no encontrada o no pertenece al usuario")
 
+        # Si la app ya tiene esta versión de la lista no se resuelven los sensores
+        etiqueta = etag("sensores", casa_id, casa.get(VERSION_SENSORES, 0))
+        if coincide(request, etiqueta):
+            return no_modificado(etiqueta)
+
         # Obtener los sensores de la casa
-        sensores_referencias = casa.get("sensores", [])
-        sensores_detallados = []
-
-        for sensor_ref in sensores_referencias:
-            sensor_obj_id = sensor_ref.get("sensor_obj_id")
-            sensor_tipo = sensor_ref.get("sensor_tipo")
-
-            if not sensor_obj_id or not sensor_tipo:
-                continue  # Saltar si la referencia no es válida
-
-            sensor_info = None
-            if sensor_tipo == "gas":
-                sensor_info = await collection_gas.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "humo":
-                sensor_info = await collection_humo.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "movimiento":
-                sensor_info = await collection_movimiento.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "sonido":
-                sensor_info = await collection_sonido.find_one({"_id": ObjectId(sensor_obj_id)})
-            elif sensor_tipo == "magnetico":
-                sensor_info = await collection_magnetico.find_one({"_id": ObjectId(sensor_obj_id)})
-
-            if sensor_info:
-                # Formatear los datos del sensor para la respuesta
-                sensor_serializable = {
-                    "_id": str(sensor_info["_id"]),
-                    "tipo": sensor_tipo,
-                    "ubicacion": sensor_info.get("ubicacion", ""),
-                    # Otros campos específicos del sensor según su tipo
-                }
-                sensores_detallados.append(sensor_serializable)
-
-        return {"message": "Sensores obtenidos con éxito", "data": sensores_detallados}
+        sensores_detallados = await resolver_sensores(casa.get("sensores", []))
+
+        return RespuestaJSON(
+            {"message": "Sensores obtenidos con éxito", "data": sensores_detallados}, headers=encabezados(etiqueta)
+        )
 
     except HTTPException as he:
         raise he
@@ -265,32 +343,88 @@ async def obtener_sensores_de_casa_especifica(
         )
         
         
-@router.get("/clientes/historial")
-async def obtener_historial():
-    try:
-        # Crear el filtro base para obtener los documentos que tengan "status"
-        filtro = {"value": {"$exists": True}}
+# Estado actual de cada sensor de la casa, servido desde memoria
+@router.get("/casas/{casa_id}/estado-actual")
+async def obtener_estado_actual(casa_id: str, token: str = Depends(oauth2_scheme)):
+    # El token basta para validar permisos; así la ruta no consulta Mongo
+    await check_token_blacklist(token)
+    payload = decode_access_token(token)
 
-        # Obtener todos los documentos filtrados, ordenados por tipo de sensor y timestamp descendente
-        cursor = collection_movimiento.find(filtro, {"_id": 0}).sort([("sensor", 1), ("timestamp", -1)])
-        documentos = await cursor.to_list(length=1000)  # Límite opcional de 1000 documentos
+    casa = estado_actual.casas.get(casa_id)
+    if casa is None:
+        # Casa creada por otro proceso: se carga una sola vez
+        casa = await estado_actual.cargar_casa(casa_id)
+    if casa is None:
+        raise HTTPException(status_code=404, detail="Casa no encontrada")
 
-        # Agrupar por tipo de sensor y filtrar los últimos dos cambios de status por cada uno
-        sensores = {}
-        for doc in documentos:
-            tipo = doc.get("sensor")
-            if tipo not in sensores:
-                sensores[tipo] = []
+    if payload.get("id") != casa.usuario_id and payload.get("rol") != "admin":
+        raise HTTPException(status_code=403, detail="No tienes permiso para ver el estado de esta casa")
 
-            # Agregar al grupo si es un cambio en el status
-            if len(sensores[tipo]) < 2:
-                if not sensores[tipo] or sensores[tipo][-1]["value"] != doc["value"]:
-                    sensores[tipo].append(doc)
+    return {"casa_id": casa_id, "sensores": estado_actual.estado_de_casa(casa)}
 
-        # Convertir el diccionario en una lista de resultados
-        resultados = [{"tipo": tipo, "eventos": eventos} for tipo, eventos in sensores.items()]
 
+# Últimos cambios de estado de cada sensor, calculados en el servidor sobre todos los tipos
+@router.get("/clientes/historial")
+async def obtener_historial(
+        n: int = Query(2, ge=1, le=100),
+        ventana_horas: Optional[float] = Query(None, gt=0)
+):
+    try:
+        # Lecturas de la API (sensor_id, estado, fecha_hora) y documentos del Arduino (sensor, value, timestamp);
+        # el modelo guarda estado=None cuando la lectura no lo trae, y eso no es un cambio de estado
+        filtro = {"sensor_id": {"$ne": None}, "estado": {"$ne": None}}
+        filtro_arduino = {"sensor": {"$ne": None}, "value": {"$ne": None}, "estado": {"$exists": False}}
+        etapas = [
+            {"$project": {
+                "_id": 0,
+                "sensor": {"$ifNull": ["$sensor", "$sensor_id"]},
+                "value": {"$ifNull": ["$value", "$estado"]},
+                "timestamp": {"$ifNull": ["$timestamp", "$fecha_hora"]},
+            }},
+        ]
+        inicio = datetime.utcnow() - timedelta(hours=ventana_horas) if ventana_horas else None
+        if inicio is None:
+            collection, pipeline = pipeline_todos_los_tipos(filtro, etapas, filtro_arduino)
+        else:
+            collection, pipeline = pipeline_todos_los_tipos(
+                {**filtro, "fecha_hora": {"$gte": inicio}}, etapas, {**filtro_arduino, "timestamp": {"$gte": inicio}}
+            )
+            # Más la última lectura de cada sensor antes de la ventana, para saber si la primera dentro de ella
+            # cambió algo; se descarta después de comparar
+            coleccion_antes, pipeline_antes = pipeline_todos_los_tipos(
+                {**filtro, "fecha_hora": {"$lt": inicio}},
+                etapas + [
+                    {"$group": {"_id": "$sensor", "ultima": {"$top": {"sortBy": {"timestamp": -1}, "output": "$$ROOT"}}}},
+                    {"$replaceRoot": {"newRoot": "$ultima"}},
+                ],
+                {**filtro_arduino, "timestamp": {"$lt": inicio}},
+            )
+            pipeline.append({"$unionWith": {"coll": coleccion_antes.name, "pipeline": pipeline_antes}})
+
+        cambios = {"$expr": {"$ne": ["$value", "$anterior"]}}
+        if inicio is not None:
+            cambios["timestamp"] = {"$gte": inicio}
+        pipeline += [
+            # Un cambio es una lectura cuyo valor difiere del anterior del mismo sensor
+            {"$setWindowFields": {
+                "partitionBy": "$sensor",
+                "sortBy": {"timestamp": 1},
+                "output": {"anterior": {"$shift": {"output": "$value", "by": -1}}},
+            }},
+            {"$match": cambios},
+            {"$group": {
+                "_id": "$sensor",
+                "eventos": {"$topN": {
+                    "n": n,
+                    "sortBy": {"timestamp": -1},
+                    "output": {"sensor": "$sensor", "value": "$value", "timestamp": "$timestamp"},
+                }},
+            }},
+            {"$sort": {"_id": 1}},
+            {"$project": {"_id": 0, "tipo": "$_id", "eventos": 1}},
+        ]
+
+        resultados = await collection.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
         return {"sensores": resultados}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener los datos: {str(e)}")
-
@@ -0,0 +1,615 @@
+import argparse
+import asyncio
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import combinations
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, PyMongoError
+
+from Modelos.models import SENSORES, database, utc_sin_zona
+
+# Modo de almacenamiento de las lecturas, se elige por despliegue:
+# - documentos: un documento por lectura en Sensores_<tipo> (comportamiento original)
+# - timeseries: colecciones time-series nativas Sensores_<tipo>_ts
+# - buckets: N lecturas por documento en Sensores_<tipo>_buckets
+MODOS = ("documentos", "timeseries", "buckets")
+MODO_ALMACENAMIENTO = os.getenv("SENSOR_STORAGE_MODE", "documentos")
+LECTURAS_POR_BUCKET = int(os.getenv("SENSOR_BUCKET_SIZE", "200"))
+
+# Esquema de colecciones, también por despliegue:
+# - separadas: una colección por tipo de sensor (comportamiento original)
+# - unificada: una sola colección `lecturas` con el campo `tipo` como discriminador
+ESQUEMAS = ("separadas", "unificada")
+ESQUEMA = os.getenv("SENSOR_LAYOUT", "separadas")
+
+if MODO_ALMACENAMIENTO not in MODOS:
+    raise ValueError(f"SENSOR_STORAGE_MODE debe ser uno de: {', '.join(MODOS)}")
+if ESQUEMA not in ESQUEMAS:
+    raise ValueError(f"SENSOR_LAYOUT debe ser uno de: {', '.join(ESQUEMAS)}")
+
+collection_lecturas = database['lecturas']
+
+# Campos que se guardan como metadatos de la serie en lugar de en cada medición
+CAMPOS_META = ("tipo", "sensor_id", "ubicacion")
+
+
+def coleccion_sensores(tipo: str = None):
+    """Colección con los documentos de un tipo de sensor (registros y lecturas en modo documentos)."""
+    if ESQUEMA == "unificada" or tipo is None:
+        return collection_lecturas
+    _, collection = SENSORES[tipo]
+    return collection
+
+
+def filtro_tipo(tipo: str, filtro: dict = None) -> dict:
+    """Agrega el discriminador de tipo al filtro cuando todas las lecturas comparten colección."""
+    filtro = dict(filtro or {})
+    if ESQUEMA == "unificada" and tipo is not None:
+        filtro["tipo"] = tipo
+    return filtro
+
+
+def colecciones_por_tipo() -> dict:
+    """Colección de cada tipo; en el esquema unificado todas apuntan a `lecturas`."""
+    return {tipo: coleccion_sensores(tipo) for tipo in SENSORES}
+
+
+def pipeline_todos_los_tipos(filtro: dict, etapas: list, filtro_sensores: dict = None) -> tuple:
+    """
+    Junta con $unionWith las lecturas de todos los tipos que cumplen `filtro`, en la
+    colección que corresponde al modo (ver pipeline_lecturas), y a cada rama le aplica
+    `etapas`. Con `filtro_sensores` también entran los documentos de las colecciones
+    de sensores que lo cumplen (p. ej. los que escribía el Arduino directamente).
+    Los filtros van en el primer $match de cada rama para que usen sus índices.
+    """
+    ramas = [pipeline_lecturas(tipo, filtro) for tipo in SENSORES]
+    if filtro_sensores is not None:
+        ramas += [(coleccion_sensores(tipo), [{"$match": filtro_tipo(tipo, filtro_sensores)}]) for tipo in SENSORES]
+    (primera, etapas_primera), resto = ramas[0], ramas[1:]
+    pipeline = etapas_primera + list(etapas) + [
+        {"$unionWith": {"coll": collection.name, "pipeline": etapas_rama + list(etapas)}}
+        for collection, etapas_rama in resto
+    ]
+    return primera, pipeline
+
+
+def coleccion_lecturas(tipo: str = None, modo: str = MODO_ALMACENAMIENTO):
+    """Colección donde se guardan las lecturas de un tipo según el modo."""
+    collection = coleccion_sensores(tipo)
+    if modo == "timeseries":
+        return database[f"{collection.name}_ts"]
+    if modo == "buckets":
+        return database[f"{collection.name}_buckets"]
+    return collection
+
+
+def colecciones_observables() -> list:
+    """
+    Colecciones distintas sobre las que se abren change streams: las de sensores, que
+    en modo documentos también tienen las lecturas. Las time-series no admiten change
+    streams y los cambios de un bucket no dicen qué lectura se agregó, así que en esos
+    modos ingesta publica las lecturas en el difusor al guardarlas.
+    """
+    colecciones = [coleccion_sensores(tipo) for tipo in SENSORES]
+    return list({collection.name: collection for collection in colecciones}.values())
+
+
+# Busca varios sensores de un mismo tipo con una sola consulta $in
+async def buscar_sensores(tipo: str, sensor_obj_ids: list, proyeccion: dict = None) -> dict:
+    """Devuelve {ObjectId: documento}; los ids que no existen simplemente no aparecen."""
+    if tipo not in SENSORES or not sensor_obj_ids:
+        return {}
+    filtro = filtro_tipo(tipo, {"_id": {"$in": [ObjectId(sensor_obj_id) for sensor_obj_id in sensor_obj_ids]}})
+    cursor = coleccion_sensores(tipo).find(filtro, proyeccion)
+    return {documento["_id"]: documento async for documento in cursor}
+
+
+# Registra un sensor nuevo en la colección de su tipo
+async def crear_sensor(tipo: str, sensor_data: dict):
+    if ESQUEMA == "unificada":
+        sensor_data.setdefault("tipo", tipo)
+    result = await coleccion_sensores(tipo).insert_one(sensor_data)
+    return result.inserted_id
+
+
+# Crea las colecciones time-series si no existen (las normales y los buckets se crean solas)
+async def preparar(modo: str = MODO_ALMACENAMIENTO):
+    await crear_colecciones_timeseries(modo)
+    await asegurar_indices(modo)
+
+
+async def crear_colecciones_timeseries(modo: str = MODO_ALMACENAMIENTO):
+    if modo != "timeseries":
+        return
+    existentes = set(await database.list_collection_names())
+    for nombre in {coleccion_lecturas(tipo, modo).name for tipo in SENSORES}:
+        if nombre in existentes:
+            continue
+        try:
+            await database.create_collection(
+                nombre,
+                timeseries={"timeField": "fecha_hora", "metaField": "meta", "granularity": "seconds"},
+            )
+        except CollectionInvalid:
+            pass  # Otro proceso la creó al mismo tiempo
+
+
+# Índices de los listados de lecturas: igualdad en un campo y luego fecha_hora, que sirve
+# tanto para el rango desde/hasta como para orden=fecha_hora sin ordenar en memoria.
+INDICES_LECTURAS = [
+    [("sensor_id", 1), ("fecha_hora", 1), ("_id", 1)],
+    [("ubicacion", 1), ("fecha_hora", 1), ("_id", 1)],
+    [("estado", 1), ("fecha_hora", 1), ("_id", 1)],
+    [("fecha_hora", 1), ("_id", 1)],
+]
+
+# En buckets el rango se resuelve con inicio/fin del bucket y estado vive dentro del arreglo
+INDICES_BUCKETS = [
+    [("sensor_id", 1), ("inicio", 1)],
+    [("ubicacion", 1), ("inicio", 1)],
+    [("inicio", 1), ("fin", 1)],
+]
+
+
+def indices_lecturas(modo: str = MODO_ALMACENAMIENTO) -> list:
+    """Lista de (colección, claves) con los índices que necesitan las consultas de lecturas."""
+    indices = []
+    colecciones = {coleccion_lecturas(tipo, modo).name: coleccion_lecturas(tipo, modo) for tipo in SENSORES}
+    for collection in colecciones.values():
+        for claves in (INDICES_BUCKETS if modo == "buckets" else INDICES_LECTURAS):
+            if modo == "timeseries":
+                # Las time-series no admiten _id en índices secundarios
+                claves = [(f"meta.{campo}" if campo in CAMPOS_META else campo, direccion)
+                          for campo, direccion in claves if campo != "_id"]
+            if ESQUEMA == "unificada":
+                claves = [("meta.tipo" if modo == "timeseries" else "tipo", 1)] + claves
+            indices.append((collection, claves))
+    return indices
+
+
+async def asegurar_indices(modo: str = MODO_ALMACENAMIENTO):
+    for collection, claves in indices_lecturas(modo):
+        await collection.create_index(claves)
+
+
+def filtro_lecturas(desde=None, hasta=None, sensor_id=None, ubicacion=None, estado=None) -> dict:
+    """
+    Filtro de Mongo para los parámetros de consulta de los listados de lecturas. Las
+    fechas quedan en UTC sin zona para poder compararlas también en memoria (archivo).
+    """
+    filtro = {}
+    if sensor_id:
+        filtro["sensor_id"] = sensor_id
+    if ubicacion:
+        filtro["ubicacion"] = ubicacion
+    if estado:
+        filtro["estado"] = estado
+    if desde or hasta:
+        filtro["fecha_hora"] = {}
+        if desde:
+            filtro["fecha_hora"]["$gte"] = utc_sin_zona(desde)
+        if hasta:
+            filtro["fecha_hora"]["$lte"] = utc_sin_zona(hasta)
+    return filtro
+
+
+def a_timeseries(documento: dict) -> dict:
+    """Mueve sensor_id y ubicacion al campo de metadatos de la serie."""
+    medicion = {clave: valor for clave, valor in documento.items() if clave not in CAMPOS_META}
+    medicion["meta"] = {campo: documento.get(campo) for campo in CAMPOS_META}
+    return medicion
+
+
+def filtro_timeseries(filtro: dict) -> dict:
+    """Traduce un filtro sobre lecturas a los campos de una colección time-series."""
+    return {
+        (f"meta.{clave}" if clave in CAMPOS_META else clave): valor
+        for clave, valor in filtro.items()
+    }
+
+
+def desde_timeseries(medicion: dict) -> dict:
+    """Devuelve una medición time-series con la forma de un documento de lectura."""
+    documento = {clave: valor for clave, valor in medicion.items() if clave != "meta"}
+    documento.update(medicion.get("meta") or {})
+    return documento
+
+
+async def _escribir_buckets(collection, documentos: list) -> list:
+    """
+    Agrega las lecturas al bucket abierto de su sensor con $push/$each.
+
+    Un bucket acepta lecturas mientras tenga menos de LECTURAS_POR_BUCKET; si no
+    hay ninguno con espacio, el upsert abre uno nuevo.
+    """
+    errores = [None] * len(documentos)
+    por_sensor = defaultdict(list)
+    for indice, documento in enumerate(documentos):
+        por_sensor[tuple(documento.get(campo) for campo in CAMPOS_META)].append(indice)
+
+    operaciones, indices_operacion = [], []
+    for meta, indices in por_sensor.items():
+        for inicio in range(0, len(indices), LECTURAS_POR_BUCKET):
+            bloque = indices[inicio:inicio + LECTURAS_POR_BUCKET]
+            lecturas = [
+                {clave: valor for clave, valor in documentos[i].items() if clave not in CAMPOS_META}
+                for i in bloque
+            ]
+            fechas = [lectura["fecha_hora"] for lectura in lecturas]
+            operaciones.append(UpdateOne(
+                {**dict(zip(CAMPOS_META, meta)), "cantidad": {"$lte": LECTURAS_POR_BUCKET - len(bloque)}},
+                {
+                    "$push": {"lecturas": {"$each": lecturas}},
+                    "$inc": {"cantidad": len(bloque)},
+                    "$min": {"inicio": min(fechas)},
+                    "$max": {"fin": max(fechas)},
+                },
+                upsert=True,
+            ))
+            indices_operacion.append(bloque)
+
+    try:
+        await collection.bulk_write(operaciones, ordered=False)
+    except BulkWriteError as e:
+        for detalle in e.details.get("writeErrors", []):
+            for indice in indices_operacion[detalle["index"]]:
+                errores[indice] = detalle.get("errmsg", "Error al guardar la lectura")
+    return errores
+
+
+# Escribe un lote de lecturas de un tipo y devuelve el error de cada una (None si se guardó)
+async def escribir(tipo: str, documentos: list, modo: str = MODO_ALMACENAMIENTO) -> list:
+    errores = [None] * len(documentos)
+    if not documentos:
+        return errores
+
+    collection = coleccion_lecturas(tipo, modo)
+    if ESQUEMA == "unificada":
+        for documento in documentos:
+            documento["tipo"] = tipo
+    if modo != "documentos":
+        # Mongo asigna el _id en insert_many; en los otros modos se asigna aquí
+        for documento in documentos:
+            documento.setdefault("_id", ObjectId())
+    if modo == "buckets":
+        return await _escribir_buckets(collection, documentos)
+
+    if modo == "timeseries":
+        destino = [a_timeseries(documento) for documento in documentos]
+    else:
+        destino = documentos
+
+    try:
+        await collection.insert_many(destino, ordered=False)
+    except BulkWriteError as e:
+        # Con ordered=False Mongo sigue con el resto y reporta el índice de cada fallo
+        for detalle in e.details.get("writeErrors", []):
+            errores[detalle["index"]] = detalle.get("errmsg", "Error al guardar la lectura")
+    return errores
+
+
+# Escribe una sola lectura; los errores de Mongo se propagan como en insert_one
+async def escribir_uno(tipo: str, documento: dict, modo: str = MODO_ALMACENAMIENTO):
+    if modo == "documentos":
+        if ESQUEMA == "unificada":
+            documento["tipo"] = tipo
+        result = await coleccion_sensores(tipo).insert_one(documento)
+        return result.inserted_id
+
+    errores = await escribir(tipo, [documento], modo)
+    if errores[0] is not None:
+        raise PyMongoError(errores[0])
+    return documento["_id"]
+
+
+# Borra lecturas por _id en el modo de almacenamiento indicado
+async def eliminar_lecturas(tipo: str, ids: list, modo: str = MODO_ALMACENAMIENTO) -> int:
+    collection = coleccion_lecturas(tipo, modo)
+    if modo == "documentos":
+        result = await collection.delete_many(filtro_tipo(tipo, {"_id": {"$in": ids}}))
+        return result.deleted_count
+    if modo == "timeseries":
+        result = await collection.delete_many({"_id": {"$in": ids}})
+        return result.deleted_count
+
+    # En buckets se quitan las lecturas del arreglo y se borran los buckets que quedan vacíos
+    result = await collection.update_many(
+        filtro_tipo(tipo, {"lecturas._id": {"$in": ids}}),
+        [
+            {"$set": {"lecturas": {"$filter": {
+                "input": "$lecturas", "cond": {"$not": [{"$in": ["$$this._id", ids]}]}
+            }}}},
+            {"$set": {"cantidad": {"$size": "$lecturas"}}},
+        ],
+    )
+    await collection.delete_many(filtro_tipo(tipo, {"cantidad": 0}))
+    return result.modified_count
+
+
+async def _leer_lectura(tipo: str, lectura_id: ObjectId, modo: str):
+    """Una lectura de los modos timeseries o buckets por su _id, con la forma de documento original."""
+    collection = coleccion_lecturas(tipo, modo)
+    if modo == "timeseries":
+        medicion = await collection.find_one(filtro_timeseries(filtro_tipo(tipo, {"_id": lectura_id})))
+        return desde_timeseries(medicion) if medicion is not None else None
+    bucket = await collection.find_one(
+        filtro_tipo(tipo, {"lecturas._id": lectura_id}), {"lecturas.$": 1, **{campo: 1 for campo in CAMPOS_META}}
+    )
+    if bucket is None:
+        return None
+    return {**bucket["lecturas"][0], **{campo: bucket.get(campo) for campo in CAMPOS_META}}
+
+
+# Cambia campos de una lectura por _id en el modo de almacenamiento indicado; False si no existe
+async def actualizar_lectura(tipo: str, lectura_id: ObjectId, cambios: dict, modo: str = MODO_ALMACENAMIENTO) -> bool:
+    """
+    En modo documentos es un $set. En timeseries y buckets sensor_id, ubicacion y
+    fecha_hora deciden en qué serie o bucket queda la lectura, así que se borra y se
+    vuelve a escribir con el mismo _id; los errores de Mongo se propagan.
+    """
+    if modo == "documentos":
+        result = await coleccion_lecturas(tipo, modo).update_one(
+            filtro_tipo(tipo, {"_id": lectura_id}), {"$set": cambios}
+        )
+        return result.matched_count > 0
+
+    documento = await _leer_lectura(tipo, lectura_id, modo)
+    if documento is None:
+        return False
+    await eliminar_lecturas(tipo, [lectura_id], modo)
+    errores = await escribir(tipo, [{**documento, **cambios, "_id": lectura_id}], modo)
+    if errores[0] is not None:
+        raise PyMongoError(errores[0])
+    return True
+
+
+def pipeline_lecturas(tipo: str = None, filtro: dict = None, modo: str = MODO_ALMACENAMIENTO) -> tuple:
+    """
+    Devuelve (colección, etapas) para usar las lecturas en un aggregate: las etapas
+    filtran y dejan cada lectura con la forma de documento original en cualquier modo.
+    Con tipo=None solo es válido en el esquema unificado.
+    """
+    filtro = filtro_tipo(tipo, filtro)
+    collection = coleccion_lecturas(tipo, modo)
+
+    if modo == "timeseries":
+        return collection, [
+            {"$match": filtro_timeseries(filtro)},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$$ROOT", "$meta"]}}},
+            {"$unset": "meta"},
+        ]
+
+    if modo == "buckets":
+        filtro_bucket = {clave: valor for clave, valor in filtro.items() if clave in CAMPOS_META}
+        filtro_lectura = {clave: valor for clave, valor in filtro.items() if clave not in CAMPOS_META}
+        # Un rango en fecha_hora descarta de entrada los buckets que no se traslapan con él
+        rango = filtro.get("fecha_hora") if isinstance(filtro.get("fecha_hora"), dict) else {}
+        if "$gte" in rango or "$gt" in rango:
+            filtro_bucket["fin"] = {"$gte": rango.get("$gte", rango.get("$gt"))}
+        if "$lte" in rango or "$lt" in rango:
+            filtro_bucket["inicio"] = {"$lte": rango.get("$lte", rango.get("$lt"))}
+        return collection, [
+            {"$match": filtro_bucket},
+            {"$unwind": "$lecturas"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+                "$lecturas", {campo: f"${campo}" for campo in CAMPOS_META}
+            ]}}},
+            {"$match": filtro_lectura},
+        ]
+
+    return collection, [{"$match": filtro}]
+
+
+def lookup_ultima_lectura(tipo: str, sensor_id, campo_salida: str, modo: str = MODO_ALMACENAMIENTO) -> dict:
+    """
+    Etapa $lookup que deja en `campo_salida` una lista con la lectura más reciente
+    del sensor; `sensor_id` es una expresión sobre el documento de entrada.
+    """
+    collection = coleccion_lecturas(tipo, modo)
+    tipo_unificado = {"tipo": tipo} if ESQUEMA == "unificada" else {}
+
+    if modo == "timeseries":
+        etapas = [
+            {"$match": {"$expr": {"$eq": ["$meta.sensor_id", "$$sensor_id"]},
+                        **{f"meta.{campo}": valor for campo, valor in tipo_unificado.items()}}},
+            {"$sort": {"fecha_hora": -1}},
+            {"$limit": 1},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$$ROOT", "$meta"]}}},
+            {"$unset": ["meta", "_id"]},
+        ]
+    elif modo == "buckets":
+        etapas = [
+            {"$match": {"$expr": {"$eq": ["$sensor_id", "$$sensor_id"]}, **tipo_unificado}},
+            {"$sort": {"fin": -1}},
+            {"$limit": 1},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+                {"$first": {"$sortArray": {"input": "$lecturas", "sortBy": {"fecha_hora": -1}}}},
+                {campo: f"${campo}" for campo in CAMPOS_META},
+            ]}}},
+            {"$unset": "_id"},
+        ]
+    else:
+        etapas = [
+            {"$match": {"$expr": {"$eq": ["$sensor_id", "$$sensor_id"]},
+                        "fecha_hora": {"$type": "date"}, **tipo_unificado}},
+            {"$sort": {"fecha_hora": -1}},
+            {"$limit": 1},
+            {"$unset": "_id"},
+        ]
+
+    return {"$lookup": {"from": collection.name, "let": {"sensor_id": sensor_id}, "pipeline": etapas,
+                        "as": campo_salida}}
+
+
+# Recorre las lecturas de un tipo con la forma de documento original, sin importar el modo
+# ni el esquema; con tipo=None recorre las de todos los tipos
+async def consultar_lecturas(tipo: str = None, filtro: dict = None, modo: str = MODO_ALMACENAMIENTO,
+                             orden: list = None, limite: int = None, proyeccion: dict = None):
+    """
+    `orden` es una lista de (campo, dirección) como en sort(); `limite` corta el
+    recorrido y `proyeccion` ({campo: 1}) limita los campos que se leen.
+    """
+    if tipo is None and ESQUEMA == "separadas":
+        for cada_tipo in SENSORES:
+            async for documento in consultar_lecturas(cada_tipo, filtro, modo, proyeccion=proyeccion):
+                yield documento
+        return
+
+    if modo == "documentos":
+        cursor = coleccion_lecturas(tipo, modo).find(filtro_tipo(tipo, filtro), proyeccion)
+    elif modo == "timeseries":
+        proyeccion_ts = {f"meta.{campo}" if campo in CAMPOS_META else campo: valor
+                         for campo, valor in proyeccion.items()} if proyeccion else None
+        cursor = coleccion_lecturas(tipo, modo).find(filtro_timeseries(filtro_tipo(tipo, filtro)), proyeccion_ts)
+    else:
+        collection, pipeline = pipeline_lecturas(tipo, filtro, modo)
+        if orden:
+            pipeline.append({"$sort": dict(orden)})
+        if limite:
+            pipeline.append({"$limit": limite})
+        if proyeccion:
+            pipeline.append({"$project": proyeccion})
+        async for documento in collection.aggregate(pipeline):
+            yield documento
+        return
+
+    if orden and modo == "timeseries":
+        orden = [(f"meta.{campo}" if campo in CAMPOS_META else campo, direccion) for campo, direccion in orden]
+    if orden:
+        cursor = cursor.sort(orden)
+    if limite:
+        cursor = cursor.limit(limite)
+    async for documento in cursor:
+        yield desde_timeseries(documento) if modo == "timeseries" else documento
+
+
+# Copia las lecturas de las colecciones originales al modo indicado
+async def migrar(modo: str, tipos=None, tamano_lote: int = 1000):
+    """Solo se copian documentos con fecha_hora; los registros de sensores se quedan donde están."""
+    await preparar(modo)
+    for tipo in tipos or SENSORES:
+        destino = coleccion_lecturas(tipo, modo)
+        async for _ in consultar_lecturas(tipo, modo=modo):
+            print(f"{destino.name} ya tiene lecturas de {tipo}, se omite")
+            break
+        else:
+            await _copiar_lecturas(tipo, modo, tamano_lote)
+
+
+async def _copiar_lecturas(tipo: str, modo: str, tamano_lote: int):
+    origen = coleccion_sensores(tipo)
+    destino = coleccion_lecturas(tipo, modo)
+    copiados, fallidos, lote = 0, 0, []
+    async for documento in origen.find(filtro_tipo(tipo, {"fecha_hora": {"$exists": True}})).sort("_id", 1):
+        lote.append(documento)
+        if len(lote) >= tamano_lote:
+            errores = await escribir(tipo, lote, modo)
+            fallidos += sum(1 for error in errores if error is not None)
+            copiados += len(lote)
+            lote = []
+    if lote:
+        errores = await escribir(tipo, lote, modo)
+        fallidos += sum(1 for error in errores if error is not None)
+        copiados += len(lote)
+
+    print(f"{tipo}: {copiados - fallidos} lecturas copiadas a {destino.name}, {fallidos} con error")
+
+
+# Copia los documentos de las cinco colecciones Sensores_<tipo> a la colección unificada
+async def unificar(tipos=None, tamano_lote: int = 1000):
+    """
+    Conserva el _id de cada documento para que las referencias de las casas sigan
+    siendo válidas; si se ejecuta de nuevo, los documentos ya copiados se omiten.
+    """
+    for tipo in tipos or SENSORES:
+        _, origen = SENSORES[tipo]
+        copiados, omitidos, lote = 0, 0, []
+
+        async def copiar(lote):
+            try:
+                result = await collection_lecturas.insert_many(lote, ordered=False)
+                return len(result.inserted_ids), 0
+            except BulkWriteError as e:
+                duplicados = sum(1 for error in e.details.get("writeErrors", []) if error.get("code") == 11000)
+                otros = len(e.details.get("writeErrors", [])) - duplicados
+                if otros:
+                    print(f"{tipo}: {otros} documentos no se pudieron copiar")
+                return e.details.get("nInserted", 0), duplicados
+
+        async for documento in origen.find():
+            documento["tipo"] = tipo
+            lote.append(documento)
+            if len(lote) >= tamano_lote:
+                insertados, duplicados = await copiar(lote)
+                copiados, omitidos, lote = copiados + insertados, omitidos + duplicados, []
+        if lote:
+            insertados, duplicados = await copiar(lote)
+            copiados, omitidos = copiados + insertados, omitidos + duplicados
+
+        print(f"{tipo}: {copiados} documentos copiados a {collection_lecturas.name}, {omitidos} ya existían")
+
+    # Índices del esquema unificado, empezando por (tipo, sensor_id, fecha_hora)
+    for claves in INDICES_LECTURAS:
+        await collection_lecturas.create_index([("tipo", 1)] + claves)
+
+
+def _usa_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(_usa_collscan(valor) for valor in plan.values())
+    if isinstance(plan, list):
+        return any(_usa_collscan(valor) for valor in plan)
+    return False
+
+
+# Revisa con explain() que cada combinación de filtros de los listados use un índice
+async def verificar_planes(modo: str = MODO_ALMACENAMIENTO) -> bool:
+    if modo == "buckets":
+        print("En modo buckets las consultas son agregaciones; no se revisan con explain()")
+        return True
+
+    ahora = datetime.utcnow()
+    valores = {"sensor_id": "sensor-1", "ubicacion": "sala", "estado": "alerta", "desde": ahora - timedelta(days=1)}
+    correcto = True
+    tipo = next(iter(SENSORES))
+    for cantidad in range(len(valores) + 1):
+        for campos in combinations(valores, cantidad):
+            filtro = filtro_lecturas(**{campo: valores[campo] for campo in campos})
+            for orden in ([("_id", 1)], [("fecha_hora", 1), ("_id", 1)]):
+                filtro_final = filtro_tipo(tipo, filtro)
+                if modo == "timeseries":
+                    filtro_final = filtro_timeseries(filtro_final)
+                    orden = [(campo, direccion) for campo, direccion in orden if campo != "_id"]
+                cursor = coleccion_lecturas(tipo, modo).find(filtro_final).sort(orden).limit(100)
+                plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+                collscan = _usa_collscan(plan)
+                correcto = correcto and not collscan
+                print(f"{'COLLSCAN' if collscan else 'IXSCAN  '} filtros={list(campos)} orden={orden[0][0]}")
+    return correcto
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migración de lecturas entre modos de almacenamiento")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    parser_migrar = subparsers.add_parser("migrar", help="Copia las lecturas existentes al modo indicado")
+    parser_migrar.add_argument("--modo", choices=["timeseries", "buckets"], required=True)
+    parser_migrar.add_argument("--tipo", choices=list(SENSORES), action="append")
+    parser_migrar.add_argument("--lote", type=int, default=1000)
+    subparsers.add_parser("indices", help="Crea los índices de las consultas de lecturas")
+    subparsers.add_parser("explicar", help="Verifica con explain() que los filtros usen índices")
+    parser_unificar = subparsers.add_parser("unificar", help="Copia las cinco colecciones a la colección `lecturas`")
+    parser_unificar.add_argument("--tipo", choices=list(SENSORES), action="append")
+    parser_unificar.add_argument("--lote", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.comando == "migrar":
+        asyncio.run(migrar(args.modo, args.tipo, args.lote))
+    elif args.comando == "unificar":
+        asyncio.run(unificar(args.tipo, args.lote))
+    elif args.comando == "indices":
+        asyncio.run(asegurar_indices())
+    elif not asyncio.run(verificar_planes()):
+        sys.exit(1)
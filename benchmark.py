@@ -0,0 +1,255 @@
+"""
+Mediciones de latencia contra un servidor en marcha.
+
+    python benchmark.py dashboard --url http://localhost:8000 --token <jwt> --cliente <id>
+
+`dashboard` compara la secuencia de llamadas que hace hoy la pantalla
+principal de la app (casas, sensores de cada casa y listados de lecturas)
+con /clientes/{id}/dashboard, e imprime p50 y p99 de cada una en ms. Los
+resultados dependen de la latencia hacia Mongo, así que conviene medir
+contra el mismo clúster que usa producción.
+
+    python benchmark.py serializacion --documentos 5000
+
+`serializacion` no necesita servidor: compara, con documentos generados,
+la ruta anterior de los listados (modelos Pydantic, validación contra el
+response_model y jsonable_encoder, o serialize_mongo_document + json.dumps)
+con serializacion.a_json.
+
+    python benchmark.py websocket --clientes 20 --eventos 20000 --tasa 5000
+
+`websocket` tampoco necesita Mongo: levanta /ws/sensores en un servidor
+local, publica eventos sintéticos de sonido en el difusor a la tasa
+indicada y compara un frame por evento con lotes de --lote-ms ms o
+--lote-eventos eventos. Imprime eventos por segundo, frames y p50/p99 de
+la latencia desde que se publica cada evento hasta que llega al cliente.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from Modelos.models import SENSORES
+from Modelos.user_models import Cliente
+from serializacion import a_json
+
+# httpx, uvicorn y websockets solo se importan en los subcomandos que los usan, así
+# `serializacion` funciona aunque no estén instalados
+
+
+def percentiles(muestras: list) -> dict:
+    cortes = statistics.quantiles(muestras, n=100, method="inclusive")
+    return {"p50": cortes[49], "p99": cortes[98]}
+
+
+async def medir(funcion, repeticiones: int, calentamiento: int = 5) -> dict:
+    for _ in range(calentamiento):
+        await funcion()
+    muestras = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        await funcion()
+        muestras.append((time.perf_counter() - inicio) * 1000)
+    return percentiles(muestras)
+
+
+async def comparar_dashboard(url: str, token: str, cliente_id: str, repeticiones: int, limite: int):
+    import httpx
+
+    async with httpx.AsyncClient(base_url=url, headers={"Authorization": f"Bearer {token}"}) as http:
+        async def secuencia_actual():
+            casas = (await http.get(f"/clientes/{cliente_id}/casas")).json()["data"]
+            for casa in casas:
+                (await http.get(f"/clientes/{cliente_id}/casas/{casa['id']}/sensores")).raise_for_status()
+            for tipo in SENSORES:
+                (await http.get(f"/sensores/{tipo}/", params={"limit": limite})).raise_for_status()
+
+        async def dashboard():
+            (await http.get(f"/clientes/{cliente_id}/dashboard")).raise_for_status()
+
+        for nombre, funcion in (("secuencia actual", secuencia_actual), ("dashboard", dashboard)):
+            resultado = await medir(funcion, repeticiones)
+            print(f"{nombre:>16}: p50 {resultado['p50']:.1f} ms, p99 {resultado['p99']:.1f} ms")
+
+
+def _serializar_anterior(doc):
+    """Copia de serialize_mongo_document, la función que usaban los listados antes de serializacion.py."""
+    if isinstance(doc, ObjectId):
+        return str(doc)
+    if isinstance(doc, datetime):
+        return doc.isoformat()
+    if isinstance(doc, dict):
+        return {key: _serializar_anterior(value) for key, value in doc.items()}
+    return doc
+
+
+def medir_sincrono(funcion, repeticiones: int) -> dict:
+    funcion()
+    muestras = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        muestras.append((time.perf_counter() - inicio) * 1000)
+    return percentiles(muestras)
+
+
+def comparar_serializacion(cantidad: int, repeticiones: int):
+    ahora = datetime.utcnow()
+    clientes = [
+        {"_id": ObjectId(), "nombre": f"Cliente {i}", "correo": f"cliente{i}@correo.com", "contraseña": None,
+         "rol": "cliente", "casas": [{"id": str(ObjectId()), "nombre": f"Casa {j}"} for j in range(3)]}
+        for i in range(cantidad)
+    ]
+    lecturas = [
+        {"_id": ObjectId(), "nombre": "gas", "sensor_id": f"gas-{i % 50}", "ubicacion": "cocina",
+         "nivel_gas": i % 1024, "estado": "normal", "fecha_hora": ahora - timedelta(seconds=i)}
+        for i in range(cantidad)
+    ]
+    adaptador = TypeAdapter(List[Cliente])
+
+    def clientes_anterior():
+        # get_clientes construía los modelos y FastAPI los volvía a validar contra response_model
+        modelos = adaptador.validate_python([Cliente(**cliente) for cliente in clientes])
+        json.dumps(jsonable_encoder(modelos, custom_encoder={ObjectId: str})).encode()
+
+    casos = (
+        ("clientes, ruta anterior", clientes_anterior),
+        ("clientes, a_json", lambda: a_json(clientes)),
+        ("lecturas, ruta anterior", lambda: json.dumps([_serializar_anterior(lectura) for lectura in lecturas]).encode()),
+        ("lecturas, a_json", lambda: a_json(lecturas)),
+    )
+    for nombre, funcion in casos:
+        resultado = medir_sincrono(funcion, repeticiones)
+        print(f"{nombre:>24}: p50 {resultado['p50']:.2f} ms, p99 {resultado['p99']:.2f} ms ({cantidad} documentos)")
+
+
+async def _cliente_websocket(url: str, token: str, lote: dict, total: int, latencias: list, suscrito: asyncio.Event,
+                             empezar: asyncio.Event) -> int:
+    """Recibe `total` eventos (o hasta que dejen de llegar) y devuelve cuántos frames hicieron falta."""
+    from websockets.asyncio.client import connect
+
+    async with connect(url, max_size=None) as ws:
+        autenticar = {"accion": "autenticar", "token": token}
+        if lote is not None:
+            autenticar["lote"] = lote
+        await ws.send(json.dumps(autenticar))
+        await ws.recv()
+        await ws.send(json.dumps({"accion": "suscribir", "tipos": ["sonido"]}))
+        await ws.recv()
+        suscrito.set()
+        await empezar.wait()
+
+        recibidos = frames = 0
+        while recibidos < total:
+            try:
+                mensaje = json.loads(await asyncio.wait_for(ws.recv(), 5))
+            except asyncio.TimeoutError:
+                break
+            ahora = time.perf_counter()
+            eventos = mensaje if isinstance(mensaje, list) else [mensaje]
+            for evento in eventos:
+                latencias.append((ahora - evento["fullDocument"]["t"]) * 1000)
+            recibidos += len(eventos)
+            frames += 1
+        return frames
+
+
+async def _publicar_sinteticos(total: int, tasa: int):
+    from almacenamiento import coleccion_lecturas
+    from difusion import difusor
+
+    nombre = coleccion_lecturas("sonido").name
+    intervalo = 0.005
+    por_intervalo = max(1, round(tasa * intervalo))
+    for inicio in range(0, total, por_intervalo):
+        for i in range(inicio, min(inicio + por_intervalo, total)):
+            difusor.publicar(nombre, {"operationType": "insert", "fullDocument": {
+                "tipo": "sonido", "sensor_id": f"sonido-{i % 50}", "nivel_sonido": i % 120, "t": time.perf_counter()
+            }})
+        await asyncio.sleep(intervalo)
+
+
+async def comparar_websocket(clientes: int, total: int, tasa: int, lote_ms: int, lote_eventos: int, puerto: int):
+    import uvicorn
+    from fastapi import FastAPI
+
+    from Routes import Sensores
+    from auth import create_access_token
+    from difusion import difusor
+
+    app = FastAPI()
+    app.include_router(Sensores.router)
+    servidor = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=puerto, log_level="warning"))
+    tarea_servidor = asyncio.create_task(servidor.serve())
+    while not servidor.started:
+        await asyncio.sleep(0.05)
+
+    url = f"ws://127.0.0.1:{puerto}/ws/sensores"
+    token = create_access_token({"sub": "benchmark", "id": "benchmark", "rol": "admin"})
+    modos = (
+        ("un frame por evento", None),
+        (f"lotes de {lote_ms} ms / {lote_eventos} eventos", {"espera_ms": lote_ms, "eventos": lote_eventos}),
+    )
+    try:
+        for nombre, lote in modos:
+            latencias = []
+            suscritos = [asyncio.Event() for _ in range(clientes)]
+            empezar = asyncio.Event()
+            tareas = [
+                asyncio.create_task(_cliente_websocket(url, token, lote, total, latencias, suscrito, empezar))
+                for suscrito in suscritos
+            ]
+            await asyncio.gather(*(suscrito.wait() for suscrito in suscritos))
+            # La medición no debe perder eventos por la política de la cola
+            for suscriptor in difusor.suscriptores:
+                suscriptor.capacidad = total
+
+            inicio = time.perf_counter()
+            empezar.set()
+            await _publicar_sinteticos(total, tasa)
+            frames = sum(await asyncio.gather(*tareas))
+            duracion = time.perf_counter() - inicio
+            resultado = percentiles(latencias)
+            print(f"{nombre:>34}: {len(latencias) / duracion:,.0f} eventos/s, {frames} frames "
+                  f"({len(latencias)} de {clientes * total} eventos), "
+                  f"latencia p50 {resultado['p50']:.1f} ms, p99 {resultado['p99']:.1f} ms")
+    finally:
+        servidor.should_exit = True
+        await tarea_servidor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mediciones de latencia de la API")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    parser_dashboard = subparsers.add_parser("dashboard", help="Secuencia de llamadas actual contra /dashboard")
+    parser_dashboard.add_argument("--url", default="http://localhost:8000")
+    parser_dashboard.add_argument("--token", required=True)
+    parser_dashboard.add_argument("--cliente", required=True)
+    parser_dashboard.add_argument("--repeticiones", type=int, default=200)
+    parser_dashboard.add_argument("--limite", type=int, default=1, help="Lecturas por listado en la secuencia actual")
+    parser_serializacion = subparsers.add_parser("serializacion", help="Ruta anterior de los listados contra a_json")
+    parser_serializacion.add_argument("--documentos", type=int, default=5000)
+    parser_serializacion.add_argument("--repeticiones", type=int, default=50)
+    parser_websocket = subparsers.add_parser("websocket", help="Un frame por evento contra lotes en /ws/sensores")
+    parser_websocket.add_argument("--clientes", type=int, default=20)
+    parser_websocket.add_argument("--eventos", type=int, default=20000, help="Eventos publicados por modo")
+    parser_websocket.add_argument("--tasa", type=int, default=5000, help="Eventos publicados por segundo")
+    parser_websocket.add_argument("--lote-ms", type=int, default=50)
+    parser_websocket.add_argument("--lote-eventos", type=int, default=100)
+    parser_websocket.add_argument("--puerto", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.comando == "dashboard":
+        asyncio.run(comparar_dashboard(args.url, args.token, args.cliente, args.repeticiones, args.limite))
+    elif args.comando == "websocket":
+        asyncio.run(comparar_websocket(args.clientes, args.eventos, args.tasa, args.lote_ms, args.lote_eventos,
+                                       args.puerto))
+    else:
+        comparar_serializacion(args.documentos, args.repeticiones)
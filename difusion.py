@@ -0,0 +1,372 @@
+import asyncio
+import os
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import estado_actual
+from Modelos.models import SENSORES
+from Modelos.user_models import collection_casa
+from almacenamiento import ESQUEMA, coleccion_lecturas, coleccion_sensores, colecciones_observables
+from escritura_diferida import Histograma
+from serializacion import a_texto
+
+REINTENTO_SEGUNDOS = 5
+# Eventos que se guardan para reenviar a los sockets que se reconectan
+HISTORIAL_MAXIMO = int(os.getenv("SENSOR_WS_REPLAY", "10000"))
+# Eventos pendientes por socket y qué hacer cuando un socket lento llena su cola:
+# - descartar_antiguos: se pierde el evento pendiente más viejo
+# - combinar: solo queda el último evento pendiente de cada sensor_id
+# - desconectar: se cierra el socket; el cliente puede reconectarse y reanudar
+POLITICAS = ("descartar_antiguos", "combinar", "desconectar")
+POLITICA = os.getenv("SENSOR_WS_POLICY", "descartar_antiguos")
+CAPACIDAD_COLA = int(os.getenv("SENSOR_WS_QUEUE", "1000"))
+# Lotes (opcionales, se piden por socket): valores por defecto, topes que puede pedir un cliente y
+# tamaño al que se corta un frame aunque no se haya cumplido la espera
+LOTE_ESPERA_MS = 50
+LOTE_EVENTOS = 100
+LOTE_ESPERA_MAXIMA_MS = int(os.getenv("SENSOR_WS_BATCH_MAX_WAIT_MS", "1000"))
+LOTE_EVENTOS_MAXIMO = int(os.getenv("SENSOR_WS_BATCH_MAX_EVENTS", "1000"))
+LOTE_BYTES_MAXIMO = int(os.getenv("SENSOR_WS_BATCH_MAX_BYTES", str(64 * 1024)))
+
+
+class Suscriptor:
+    """
+    Un socket de /ws/sensores. El difusor le encola eventos y el socket los
+    envía a su ritmo; la cola tiene un máximo y al llenarse se aplica la
+    política del socket, así un cliente lento no frena a los demás ni hace
+    crecer la memoria. `claves` son sus suscripciones, con la forma de las
+    claves del índice del difusor.
+    """
+    __slots__ = ("numero", "claves", "politica", "capacidad", "pendientes", "hay_pendientes", "desbordado",
+                 "encolados", "enviados", "frames", "descartados", "combinados", "ultimo_seq", "esperas_ms")
+
+    def __init__(self, numero: int, politica: str = POLITICA, capacidad: int = CAPACIDAD_COLA):
+        self.numero = numero
+        self.claves = set()
+        self.politica = politica
+        self.capacidad = capacidad
+        # sensor_id (al combinar) o seq -> Evento, en orden de llegada
+        self.pendientes = OrderedDict()
+        self.hay_pendientes = asyncio.Event()
+        self.desbordado = False
+        self.encolados = 0
+        self.enviados = 0
+        self.frames = 0
+        self.descartados = 0
+        self.combinados = 0
+        self.ultimo_seq = 0
+        self.esperas_ms = Histograma([1, 5, 10, 50, 100, 500, 1000, 5000])
+
+    def encolar(self, evento):
+        if self.desbordado:
+            return
+        self.encolados += 1
+        clave = evento.seq
+        if self.politica == "combinar" and evento.sensor_id is not None:
+            clave = ("sensor", evento.sensor_id)
+            if self.pendientes.pop(clave, None) is not None:
+                self.combinados += 1
+        self.pendientes[clave] = evento
+        if len(self.pendientes) > self.capacidad:
+            if self.politica == "desconectar":
+                self.desbordado = True
+                self.pendientes.clear()
+            else:
+                self.pendientes.popitem(last=False)
+                self.descartados += 1
+        self.hay_pendientes.set()
+
+    async def esperar(self, segundos: float = None) -> bool:
+        """Espera a que haya eventos pendientes, como mucho `segundos`; True si hay alguno."""
+        if not self.pendientes and not self.desbordado:
+            self.hay_pendientes.clear()
+            try:
+                await asyncio.wait_for(self.hay_pendientes.wait(), segundos)
+            except asyncio.TimeoutError:
+                pass
+        return bool(self.pendientes)
+
+    def tomar(self):
+        """Saca el evento pendiente más viejo; None si no hay."""
+        if not self.pendientes:
+            return None
+        _, evento = self.pendientes.popitem(last=False)
+        return evento
+
+    def enviado(self, eventos: list):
+        """Registra un frame enviado con uno o más eventos."""
+        ahora = time.monotonic()
+        self.frames += 1
+        self.enviados += len(eventos)
+        self.ultimo_seq = eventos[-1].seq
+        for evento in eventos:
+            self.esperas_ms.registrar((ahora - evento.publicado) * 1000)
+
+    def metricas(self) -> dict:
+        antiguo = next(iter(self.pendientes.values()), None)
+        return {
+            "politica": self.politica,
+            "pendientes": len(self.pendientes),
+            "capacidad": self.capacidad,
+            "encolados": self.encolados,
+            "enviados": self.enviados,
+            "frames": self.frames,
+            "descartados": self.descartados,
+            "combinados": self.combinados,
+            "ultimo_seq": self.ultimo_seq,
+            # Retraso actual: cuánto lleva esperando el evento pendiente más viejo
+            "antiguedad_ms": (time.monotonic() - antiguo.publicado) * 1000 if antiguo else 0,
+            "espera_ms": self.esperas_ms.resumen(),
+        }
+
+
+class Evento:
+    """Un cambio publicado; se serializa (con su `seq`) la primera vez que alguien lo necesita."""
+    __slots__ = ("seq", "tipo", "sensor_id", "cambio", "texto", "publicado")
+
+    def __init__(self, seq, tipo, sensor_id, cambio):
+        self.publicado = time.monotonic()
+        self.seq = seq
+        self.tipo = tipo
+        self.sensor_id = sensor_id
+        self.cambio = cambio
+        self.texto = None
+
+    def serializado(self) -> str:
+        if self.texto is None:
+            self.texto = a_texto({"seq": self.seq, **self.cambio})
+        return self.texto
+
+
+# Claves del índice de suscripciones
+def clave_casa(casa_id: str) -> tuple:
+    return ("casa", casa_id)
+
+
+def clave_sensor(sensor_id: str) -> tuple:
+    return ("sensor", sensor_id)
+
+
+def clave_tipo(tipo: str, usuario_id: str = None) -> tuple:
+    """Sin usuario_id es el tipo en todas las casas (solo admin); con usuario_id, en las casas de ese usuario."""
+    return ("tipo", tipo, usuario_id)
+
+
+class Difusor:
+    """
+    Un solo change stream por colección para todo el proceso, sin importar
+    cuántos sockets haya abiertos. Cada evento se busca en el índice de
+    suscripciones por su sensor_id, las casas de ese sensor y su tipo; solo si
+    alguien lo quiere se serializa, una vez, y el mismo texto se deja en la
+    cola de cada interesado (ver Suscriptor). Los oyentes (p. ej. estado_actual) reciben todos
+    los cambios sin serializar.
+
+    Cada evento lleva un `seq` creciente dentro de la `instancia` del proceso y
+    los últimos HISTORIAL_MAXIMO se guardan para que un socket que se reconecta
+    pida lo que se perdió con `reanudar`.
+
+    En modo documentos las lecturas llegan por los change streams, también las
+    que guardan otros procesos; en timeseries y buckets ingesta las publica con
+    `publicar_lecturas` al guardarlas, así que solo se ven las de este proceso.
+    Los eventos sin fullDocument (borrados) no traen sensor_id: solo llegan a
+    quien está suscrito al tipo completo.
+
+    También sigue la colección de casas para mantener al día las casas en
+    memoria de estado_actual, con las que se eligen los destinatarios.
+    """
+
+    def __init__(self):
+        self.suscriptores = set()
+        self.conexiones = 0
+        self.oyentes = []
+        # clave -> {Suscriptor}
+        self.indice = {}
+        # Identifica al proceso: los seq de otra instancia (o de antes de reiniciar) no sirven para reanudar
+        self.instancia = uuid.uuid4().hex
+        self.seq = 0
+        self.historial = deque(maxlen=HISTORIAL_MAXIMO)
+        self._tareas = []
+        # Nombre de colección -> tipo, para los esquemas con una colección por tipo
+        self._tipos = {
+            collection.name: tipo
+            for tipo in SENSORES for collection in (coleccion_sensores(tipo), coleccion_lecturas(tipo))
+        }
+
+    def suscribir(self, politica: str = POLITICA) -> Suscriptor:
+        self.conexiones += 1
+        suscriptor = Suscriptor(self.conexiones, politica)
+        self.suscriptores.add(suscriptor)
+        return suscriptor
+
+    def agregar(self, suscriptor: Suscriptor, claves):
+        for clave in claves:
+            self.indice.setdefault(clave, set()).add(suscriptor)
+            suscriptor.claves.add(clave)
+
+    def quitar(self, suscriptor: Suscriptor, claves):
+        for clave in claves:
+            interesados = self.indice.get(clave)
+            if interesados is not None:
+                interesados.discard(suscriptor)
+                if not interesados:
+                    del self.indice[clave]
+            suscriptor.claves.discard(clave)
+
+    def desuscribir(self, suscriptor: Suscriptor):
+        self.quitar(suscriptor, list(suscriptor.claves))
+        self.suscriptores.discard(suscriptor)
+
+    def agregar_oyente(self, oyente):
+        """`oyente(tipo, cambio)` se llama con cada cambio de cualquier colección observada."""
+        self.oyentes.append(oyente)
+
+    def tipo_de(self, nombre_coleccion: str, cambio: dict):
+        if ESQUEMA == "unificada":
+            return (cambio.get("fullDocument") or {}).get("tipo")
+        return self._tipos.get(nombre_coleccion)
+
+    def claves_de(self, tipo: str, sensor_id) -> list:
+        """Claves del índice que reciben un evento de este tipo y sensor."""
+        claves = [clave_tipo(tipo)]
+        if sensor_id is not None:
+            claves.append(clave_sensor(sensor_id))
+            for casa_id in estado_actual.casas_por_sensor.get(sensor_id, ()):
+                claves.append(clave_casa(casa_id))
+                casa = estado_actual.casas.get(casa_id)
+                if casa is not None:
+                    claves.append(clave_tipo(tipo, casa.usuario_id))
+        return claves
+
+    def destinatarios(self, tipo: str, sensor_id) -> set:
+        interesados = set()
+        for clave in self.claves_de(tipo, sensor_id):
+            interesados.update(self.indice.get(clave, ()))
+        return interesados
+
+    def publicar(self, nombre_coleccion: str, cambio: dict):
+        tipo = self.tipo_de(nombre_coleccion, cambio)
+        for oyente in self.oyentes:
+            # Un oyente que falla no debe cortar el stream compartido ni dejar a los sockets sin el evento
+            try:
+                oyente(tipo, cambio)
+            except Exception:
+                print(f"Error en un oyente del difusor ({nombre_coleccion}):")
+                print(traceback.format_exc())
+        self.seq += 1
+        evento = Evento(self.seq, tipo, (cambio.get("fullDocument") or {}).get("sensor_id"), cambio)
+        self.historial.append(evento)
+        if not self.indice:
+            return
+        for suscriptor in self.destinatarios(evento.tipo, evento.sensor_id):
+            suscriptor.encolar(evento)
+
+    def publicar_lecturas(self, tipo: str, documentos: list):
+        """Publica lecturas recién guardadas como los inserts que entregaría un change stream."""
+        collection = coleccion_lecturas(tipo)
+        for documento in documentos:
+            self.publicar(collection.name, {
+                "operationType": "insert",
+                "ns": {"db": collection.database.name, "coll": collection.name},
+                "documentKey": {"_id": documento["_id"]},
+                "fullDocument": documento,
+            })
+
+    def reanudar(self, suscriptor: Suscriptor, instancia: str, desde: int) -> tuple:
+        """
+        Encola los eventos posteriores a `desde` que corresponden a las suscripciones
+        actuales del socket. Devuelve (reenviados, perdidos); `perdidos` indica que
+        hubo eventos que ya no están en el historial y el cliente debe recargar el estado.
+        """
+        if instancia != self.instancia or desde > self.seq:
+            return 0, True
+        primero = self.historial[0].seq if self.historial else self.seq + 1
+        perdidos = desde + 1 < primero
+        reenviados = 0
+        for evento in islice(self.historial, max(desde + 1 - primero, 0), None):
+            if not suscriptor.claves.isdisjoint(self.claves_de(evento.tipo, evento.sensor_id)):
+                suscriptor.encolar(evento)
+                reenviados += 1
+        return reenviados, perdidos
+
+    def metricas(self) -> dict:
+        return {
+            "seq": self.seq,
+            "historial": len(self.historial),
+            "suscriptores": {suscriptor.numero: suscriptor.metricas() for suscriptor in self.suscriptores},
+        }
+
+    async def _seguir(self, collection, manejar=None, recuperar=None):
+        """
+        Sin `manejar` cada cambio se publica. Con `manejar` (async) se le entrega a
+        él, y si el stream no se puede retomar se espera `recuperar()` para volver a
+        leer lo que se haya perdido.
+        """
+        # Si el stream se corta se retoma desde el último cambio recibido, sin huecos
+        token = None
+        por_recuperar = False
+        while True:
+            try:
+                async with collection.watch(resume_after=token) as stream:
+                    if por_recuperar:
+                        # Con el stream ya abierto, para no perder lo que cambie mientras se recupera
+                        await recuperar()
+                        por_recuperar = False
+                    async for cambio in stream:
+                        token = stream.resume_token
+                        if manejar is None:
+                            self.publicar(collection.name, cambio)
+                        else:
+                            await manejar(cambio)
+            except OperationFailure as e:
+                if token is None:
+                    # Sin réplica el servidor rechaza los change streams; reintentar no sirve de nada
+                    print(f"Change streams no disponibles en {collection.name}: {e}")
+                    return
+                # El token ya salió del oplog (p. ej. ChangeStreamHistoryLost): se vuelve a empezar desde
+                # ahora, y al cambiar de instancia los clientes que reanuden reciben `perdidos`
+                print(f"No se pudo retomar el change stream de {collection.name}, se reinicia: {e}")
+                token = None
+                if manejar is None:
+                    self.instancia = uuid.uuid4().hex
+                else:
+                    por_recuperar = True
+            except PyMongoError as e:
+                print(f"Se cortó el change stream de {collection.name}, reintentando: {e}")
+                await asyncio.sleep(REINTENTO_SEGUNDOS)
+            except Exception:
+                # Cualquier otro error tampoco debe dejar la colección sin stream para todos los sockets
+                print(f"Error en el change stream de {collection.name}, reintentando:")
+                print(traceback.format_exc())
+                await asyncio.sleep(REINTENTO_SEGUNDOS)
+
+    def iniciar(self):
+        self._tareas = [asyncio.create_task(self._seguir(collection)) for collection in colecciones_observables()]
+        # Las casas y sensores en memoria (rutas de estado actual y destinatarios de los eventos) siguen los
+        # cambios de Casas, también los que hacen otros procesos
+        self._tareas.append(asyncio.create_task(
+            self._seguir(collection_casa, estado_actual.casa_cambiada, estado_actual.cargar_casas)
+        ))
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+
+difusor = Difusor()
+
+
+async def iniciar():
+    if estado_actual.SEGUIR_CAMBIOS:
+        difusor.agregar_oyente(estado_actual.al_cambiar)
+    difusor.iniciar()
+
+
+async def detener():
+    await difusor.detener()
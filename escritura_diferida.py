@@ -0,0 +1,126 @@
+import asyncio
+import bisect
+import os
+import time
+
+# Configuración de la escritura diferida (desactivada por defecto)
+ESCRITURA_DIFERIDA = os.getenv("SENSOR_WRITE_BEHIND", "0") == "1"
+TAMANO_LOTE = int(os.getenv("SENSOR_WRITE_BEHIND_BATCH", "500"))
+ESPERA_MAXIMA = float(os.getenv("SENSOR_WRITE_BEHIND_MAX_WAIT_MS", "200")) / 1000
+CAPACIDAD = int(os.getenv("SENSOR_WRITE_BEHIND_CAPACITY", "10000"))
+
+
+class Histograma:
+    """Histograma acumulado con límites fijos, suficiente para exponer métricas sin dependencias."""
+
+    def __init__(self, limites):
+        self.limites = list(limites)
+        self.cubetas = [0] * (len(self.limites) + 1)
+        self.cantidad = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+
+    def registrar(self, valor):
+        self.cubetas[bisect.bisect_left(self.limites, valor)] += 1
+        self.cantidad += 1
+        self.suma += valor
+        self.maximo = max(self.maximo, valor)
+
+    def resumen(self) -> dict:
+        etiquetas = [f"<={limite}" for limite in self.limites] + [f">{self.limites[-1]}"]
+        return {
+            "cantidad": self.cantidad,
+            "promedio": self.suma / self.cantidad if self.cantidad else 0,
+            "maximo": self.maximo,
+            "cubetas": dict(zip(etiquetas, self.cubetas)),
+        }
+
+
+class BufferEscritura:
+    """
+    Buffer en memoria que agrupa documentos y los entrega a `escribir` en lotes.
+
+    Un lote se escribe cuando junta `tamano_lote` documentos o cuando el más antiguo
+    lleva `espera_maxima` segundos esperando. La cola es acotada: `agregar` se
+    bloquea mientras esté llena, lo que frena a quien produce las lecturas.
+    """
+
+    def __init__(self, nombre, escribir, tamano_lote=TAMANO_LOTE, espera_maxima=ESPERA_MAXIMA, capacidad=CAPACIDAD):
+        self.nombre = nombre
+        self.escribir = escribir
+        self.tamano_lote = tamano_lote
+        self.espera_maxima = espera_maxima
+        self.cola = asyncio.Queue(maxsize=capacidad)
+        self.tamanos_lote = Histograma([1, 10, 50, 100, 250, 500, 1000])
+        self.esperas_ms = Histograma([1, 5, 10, 25, 50, 100, 250, 500, 1000])
+        self.errores = 0
+        self._tarea = None
+
+    def iniciar(self):
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._vaciar_continuamente())
+
+    async def agregar(self, documento):
+        self.iniciar()
+        await self.cola.put((time.monotonic(), documento))
+
+    async def _vaciar_continuamente(self):
+        while True:
+            primero = await self.cola.get()
+            lote = [primero]
+            limite = primero[0] + self.espera_maxima
+
+            while len(lote) < self.tamano_lote:
+                # Primero toma lo que ya está en la cola sin esperar
+                if not self.cola.empty():
+                    lote.append(self.cola.get_nowait())
+                    continue
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(await asyncio.wait_for(self.cola.get(), restante))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._escribir_lote(lote)
+
+    async def _escribir_lote(self, lote):
+        ahora = time.monotonic()
+        for encolado, _ in lote:
+            self.esperas_ms.registrar((ahora - encolado) * 1000)
+        self.tamanos_lote.registrar(len(lote))
+
+        try:
+            errores = await self.escribir([documento for _, documento in lote])
+            fallidos = sum(1 for error in errores if error is not None)
+            if fallidos:
+                self.errores += fallidos
+                print(f"Escritura diferida '{self.nombre}': {fallidos} documentos no se guardaron")
+        except Exception as e:
+            self.errores += len(lote)
+            print(f"Error en la escritura diferida '{self.nombre}': {e}")
+        finally:
+            for _ in lote:
+                self.cola.task_done()
+
+    async def detener(self):
+        """Espera a que se escriba todo lo pendiente y detiene la tarea de vaciado."""
+        if self._tarea is None:
+            return
+        await self.cola.join()
+        self._tarea.cancel()
+        try:
+            await self._tarea
+        except asyncio.CancelledError:
+            pass
+        self._tarea = None
+
+    def metricas(self) -> dict:
+        return {
+            "pendientes": self.cola.qsize(),
+            "capacidad": self.cola.maxsize,
+            "errores": self.errores,
+            "tamano_lote": self.tamanos_lote.resumen(),
+            "espera_ms": self.esperas_ms.resumen(),
+        }
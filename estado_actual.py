@@ -0,0 +1,184 @@
+import asyncio
+import os
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from Modelos.models import SENSORES, CAMPO_VALOR, utc_sin_zona
+from Modelos.user_models import collection_casa
+from almacenamiento import MODO_ALMACENAMIENTO, buscar_sensores, pipeline_lecturas
+from versiones import VERSION_SENSORES
+
+# Con los change streams del difusor también se ven las lecturas que guardan otros procesos (requiere réplica).
+# En timeseries y buckets los change streams no entregan lecturas sueltas; basta con lo que registra ingesta
+SEGUIR_CAMBIOS = os.getenv("SENSOR_STATE_WATCH", "1") == "1" and MODO_ALMACENAMIENTO == "documentos"
+
+
+class Lectura:
+    """Última lectura de un sensor; __slots__ evita un dict por cada uno de los miles de sensores."""
+    __slots__ = ("tipo", "valor", "estado", "ubicacion", "fecha_hora")
+
+    def __init__(self, tipo, valor, estado, ubicacion, fecha_hora):
+        self.tipo = tipo
+        self.valor = valor
+        self.estado = estado
+        self.ubicacion = ubicacion
+        self.fecha_hora = fecha_hora
+
+    def a_dict(self) -> dict:
+        return {"tipo": self.tipo, "valor": self.valor, "estado": self.estado,
+                "ubicacion": self.ubicacion, "fecha_hora": self.fecha_hora}
+
+
+class CasaCache:
+    """Dueño de la casa y sus sensores como tuplas (sensor_id, tipo, ubicacion)."""
+    __slots__ = ("usuario_id", "sensores")
+
+    def __init__(self, usuario_id, sensores):
+        self.usuario_id = usuario_id
+        self.sensores = sensores
+
+
+# sensor_id -> Lectura, casa_id -> CasaCache y sensor_id -> {casa_id}, todos locales al proceso
+ultimas = {}
+casas = {}
+casas_por_sensor = {}
+
+
+def actualizar(tipo: str, documento: dict):
+    """Registra una lectura si es más reciente que la que ya se tiene de su sensor."""
+    sensor_id = documento.get("sensor_id")
+    fecha_hora = utc_sin_zona(documento.get("fecha_hora"))
+    if sensor_id is None or not isinstance(fecha_hora, datetime):
+        return
+    actual = ultimas.get(sensor_id)
+    if actual is not None and actual.fecha_hora > fecha_hora:
+        return
+    campo = CAMPO_VALOR.get(tipo)
+    ultimas[sensor_id] = Lectura(tipo, documento.get(campo) if campo else None, documento.get("estado"),
+                                 documento.get("ubicacion"), fecha_hora)
+
+
+def registrar(tipo: str, documentos: list):
+    for documento in documentos:
+        actualizar(tipo, documento)
+
+
+# Carga la última lectura de cada sensor con una agregación por tipo
+async def calentar():
+    for tipo in SENSORES:
+        collection, etapas = pipeline_lecturas(tipo, {"sensor_id": {"$ne": None}, "fecha_hora": {"$type": "date"}})
+        pipeline = etapas + [
+            {"$group": {"_id": "$sensor_id", "ultima": {"$top": {"sortBy": {"fecha_hora": -1}, "output": "$$ROOT"}}}},
+        ]
+        async for grupo in collection.aggregate(pipeline):
+            actualizar(tipo, grupo["ultima"])
+
+    await cargar_casas()
+
+
+# Vuelve a leer todas las casas y olvida las que ya no existen
+async def cargar_casas():
+    vistas = set()
+    async for casa in collection_casa.find({}, {"usuario_id": 1, "sensores": 1}):
+        await _guardar_casa(casa)
+        vistas.add(str(casa["_id"]))
+    for casa_id in set(casas) - vistas:
+        _olvidar_casa(casa_id)
+
+
+async def _guardar_casa(casa: dict):
+    # Los registros de sensores se identifican en las lecturas por su sensor_id, o por su _id si no tienen
+    referencias = [
+        (referencia["sensor_tipo"], ObjectId(referencia["sensor_obj_id"]))
+        for referencia in casa.get("sensores", [])
+        if isinstance(referencia, dict) and referencia.get("sensor_tipo") in SENSORES
+        and ObjectId.is_valid(referencia.get("sensor_obj_id"))
+    ]
+    ids_por_tipo = {}
+    for tipo, sensor_obj_id in referencias:
+        ids_por_tipo.setdefault(tipo, []).append(sensor_obj_id)
+    tipos = list(ids_por_tipo)
+    encontrados = dict(zip(tipos, await asyncio.gather(
+        *(buscar_sensores(tipo, ids_por_tipo[tipo], {"sensor_id": 1, "ubicacion": 1}) for tipo in tipos)
+    )))
+
+    sensores = []
+    for tipo, sensor_obj_id in referencias:
+        registro = encontrados[tipo].get(sensor_obj_id)
+        if registro is not None:
+            sensores.append((registro.get("sensor_id") or str(registro["_id"]), tipo, registro.get("ubicacion")))
+    casa_id = str(casa["_id"])
+    _olvidar_casa(casa_id)
+    casas[casa_id] = CasaCache(str(casa.get("usuario_id")), tuple(sensores))
+    for sensor_id, _, _ in sensores:
+        casas_por_sensor.setdefault(sensor_id, set()).add(casa_id)
+
+
+def _olvidar_casa(casa_id: str):
+    anterior = casas.pop(casa_id, None)
+    if anterior is None:
+        return
+    for sensor_id, _, _ in anterior.sensores:
+        ids = casas_por_sensor.get(sensor_id)
+        if ids is not None:
+            ids.discard(casa_id)
+            if not ids:
+                del casas_por_sensor[sensor_id]
+
+
+# Vuelve a leer una casa; lo llaman las rutas que le agregan casas o sensores y el change stream de Casas
+async def cargar_casa(casa_id: str):
+    if not ObjectId.is_valid(casa_id):
+        return None
+    casa = await collection_casa.find_one({"_id": ObjectId(casa_id)}, {"usuario_id": 1, "sensores": 1})
+    if casa is None:
+        _olvidar_casa(casa_id)
+        return None
+    await _guardar_casa(casa)
+    return casas[casa_id]
+
+
+# Campos de una casa que cambian lo que se guarda de ella; VERSION_SENSORES sube cuando cambia un registro de sensor
+CAMPOS_CASA = ("usuario_id", "sensores", VERSION_SENSORES)
+
+
+async def casa_cambiada(cambio: dict):
+    """Cambio del change stream de Casas, hecho por este o por otro proceso: relee u olvida la casa."""
+    casa_id = str(cambio["documentKey"]["_id"])
+    operacion = cambio.get("operationType")
+    if operacion == "delete":
+        _olvidar_casa(casa_id)
+    elif operacion == "update":
+        descripcion = cambio.get("updateDescription", {})
+        campos = [*descripcion.get("updatedFields", {}), *descripcion.get("removedFields", [])]
+        if any(campo.split(".")[0] in CAMPOS_CASA for campo in campos):
+            await cargar_casa(casa_id)
+    elif operacion in ("insert", "replace"):
+        await cargar_casa(casa_id)
+
+
+def estado_de_casa(casa: CasaCache) -> list:
+    """Estado actual de los sensores de una casa, sin consultar Mongo."""
+    estado = []
+    for sensor_id, tipo, ubicacion in casa.sensores:
+        lectura = ultimas.get(sensor_id)
+        if lectura is None:
+            estado.append({"sensor_id": sensor_id, "tipo": tipo, "ubicacion": ubicacion, "sin_lecturas": True})
+        else:
+            estado.append({"sensor_id": sensor_id, **lectura.a_dict()})
+    return estado
+
+
+def al_cambiar(tipo: str, cambio: dict):
+    """Oyente del difusor: registra las lecturas que insertan otros procesos."""
+    if cambio.get("operationType") == "insert" and tipo in SENSORES:
+        actualizar(tipo, cambio["fullDocument"])
+
+
+async def iniciar():
+    try:
+        await calentar()
+    except PyMongoError as e:
+        print(f"Error al cargar el estado actual de los sensores: {e}")
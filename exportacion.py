@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import csv
+import io
+import os
+import sys
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Modelos.models import SENSORES, CAMPOS_LECTURA
+from almacenamiento import consultar_lecturas, filtro_lecturas
+from estado_actual import cargar_casa
+
+# Filas que se juntan antes de escribir un bloque CSV o un row group de Parquet
+TAMANO_BLOQUE = int(os.getenv("SENSOR_EXPORT_CHUNK", "5000"))
+FORMATOS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+# Esquema fijo para todos los tipos: columnas comunes y luego las mediciones numéricas de cada tipo
+COLUMNAS_COMUNES = ["_id", "tipo", "sensor_id", "ubicacion", "estado", "fecha_hora"]
+COLUMNAS = COLUMNAS_COMUNES + list(dict.fromkeys(
+    campo for campos in CAMPOS_LECTURA.values() for campo in campos
+    if campo not in COLUMNAS_COMUNES and campo != "nombre"
+))
+ESQUEMA = pa.schema(
+    [("_id", pa.string()), ("tipo", pa.string()), ("sensor_id", pa.string()), ("ubicacion", pa.string()),
+     ("estado", pa.string()), ("fecha_hora", pa.timestamp("ms"))]
+    + [(columna, pa.float64()) for columna in COLUMNAS[len(COLUMNAS_COMUNES):]]
+)
+
+
+def sensores_a_exportar(casa=None, sensor_id: str = None) -> dict:
+    """{tipo: [sensor_id, ...]} de la casa (un CasaCache), o del sensor indicado en todos los tipos."""
+    if casa is None:
+        return {tipo: [sensor_id] for tipo in SENSORES}
+    por_tipo = {}
+    for id_sensor, tipo, _ in casa.sensores:
+        if sensor_id is None or id_sensor == sensor_id:
+            por_tipo.setdefault(tipo, []).append(id_sensor)
+    return por_tipo
+
+
+def _a_fila(tipo: str, documento: dict) -> dict:
+    fila = {columna: documento.get(columna) for columna in COLUMNAS}
+    fila["tipo"] = tipo
+    for columna in ("_id", "sensor_id", "ubicacion", "estado"):
+        if fila[columna] is not None:
+            fila[columna] = str(fila[columna])
+    for columna in COLUMNAS[len(COLUMNAS_COMUNES):]:
+        valor = fila[columna]
+        fila[columna] = float(valor) if isinstance(valor, (int, float)) else None
+    return fila
+
+
+# Recorre las lecturas pedidas en bloques de `tamano_bloque` filas, sin juntar el resultado completo
+async def bloques_de_lecturas(por_tipo: dict, desde: datetime = None, hasta: datetime = None,
+                              tamano_bloque: int = TAMANO_BLOQUE):
+    bloque = []
+    for tipo, ids in por_tipo.items():
+        filtro = filtro_lecturas(desde, hasta)
+        filtro["sensor_id"] = ids[0] if len(ids) == 1 else {"$in": ids}
+        async for documento in consultar_lecturas(tipo, filtro, orden=[("fecha_hora", 1), ("_id", 1)]):
+            bloque.append(_a_fila(tipo, documento))
+            if len(bloque) >= tamano_bloque:
+                yield bloque
+                bloque = []
+    if bloque:
+        yield bloque
+
+
+def _csv(filas: list, encabezado: bool) -> str:
+    salida = io.StringIO()
+    escritor = csv.DictWriter(salida, fieldnames=COLUMNAS)
+    if encabezado:
+        escritor.writeheader()
+    for fila in filas:
+        fila["fecha_hora"] = fila["fecha_hora"].isoformat() if fila["fecha_hora"] else None
+        escritor.writerow(fila)
+    return salida.getvalue()
+
+
+async def exportar_csv(bloques):
+    encabezado = True
+    async for filas in bloques:
+        yield _csv(filas, encabezado).encode()
+        encabezado = False
+    if encabezado:
+        # Sin lecturas: solo el encabezado
+        yield _csv([], True).encode()
+
+
+class SalidaEnBloques(io.RawIOBase):
+    """
+    Archivo de solo escritura que guarda lo escrito hasta que se extrae; permite
+    mandar un Parquet por partes mientras ParquetWriter lo sigue escribiendo.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._pendiente = bytearray()
+        self._posicion = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, datos) -> int:
+        self._pendiente.extend(datos)
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self) -> int:
+        return self._posicion
+
+    def extraer(self) -> bytes:
+        datos = bytes(self._pendiente)
+        self._pendiente.clear()
+        return datos
+
+
+async def exportar_parquet(bloques):
+    """Un row group por bloque; cada uno se envía en cuanto queda escrito."""
+    salida = SalidaEnBloques()
+    escritor = pq.ParquetWriter(salida, ESQUEMA, compression="zstd")
+    try:
+        async for filas in bloques:
+            tabla = pa.Table.from_pylist(filas, schema=ESQUEMA)
+            await asyncio.to_thread(escritor.write_table, tabla)
+            yield salida.extraer()
+    finally:
+        escritor.close()
+    yield salida.extraer()
+
+
+def exportar(formato: str, bloques):
+    return exportar_csv(bloques) if formato == "csv" else exportar_parquet(bloques)
+
+
+async def exportar_a_archivo(destino: str, formato: str, casa_id: str = None, sensor_id: str = None,
+                             desde: datetime = None, hasta: datetime = None):
+    casa = None
+    if casa_id is not None:
+        casa = await cargar_casa(casa_id)
+        if casa is None:
+            raise SystemExit(f"Casa no encontrada: {casa_id}")
+    por_tipo = sensores_a_exportar(casa, sensor_id)
+    with open(destino, "wb") if destino != "-" else sys.stdout.buffer as archivo:
+        async for datos in exportar(formato, bloques_de_lecturas(por_tipo, desde, hasta)):
+            archivo.write(datos)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporta lecturas de una casa o de un sensor a CSV o Parquet")
+    parser.add_argument("--casa", help="_id de la casa")
+    parser.add_argument("--sensor-id", help="sensor_id de las lecturas")
+    parser.add_argument("--desde", type=datetime.fromisoformat, help="Fecha inicial (ISO 8601)")
+    parser.add_argument("--hasta", type=datetime.fromisoformat, help="Fecha final (ISO 8601)")
+    parser.add_argument("--formato", choices=list(FORMATOS), default="csv")
+    parser.add_argument("--salida", default="-", help="Archivo de salida; '-' para la salida estándar")
+    args = parser.parse_args()
+    if not args.casa and not args.sensor_id:
+        parser.error("Indica --casa o --sensor-id")
+
+    asyncio.run(exportar_a_archivo(args.salida, args.formato, args.casa, args.sensor_id, args.desde, args.hasta))
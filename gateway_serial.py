@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from functools import partial
+
+import serial
+
+from Modelos.models import SENSORES, CAMPO_VALOR
+from escritura_diferida import BufferEscritura
+from ingesta import validar_lectura, guardar_documentos, LecturaInvalida
+
+# Configuración del puerto serie (sin ARDUINO_PORT el gateway no se inicia)
+ARDUINO_PORT = os.getenv("ARDUINO_PORT")  # p. ej. COM6 o /dev/ttyACM0
+BAUD_RATE = int(os.getenv("ARDUINO_BAUD_RATE", "9600"))
+TAMANO_LOTE = int(os.getenv("ARDUINO_BATCH", "100"))
+ESPERA_MAXIMA = float(os.getenv("ARDUINO_MAX_WAIT_MS", "500")) / 1000
+REINTENTO_SEGUNDOS = 5
+LINEA_MAXIMA = 4096
+
+
+def interpretar_linea(texto: str) -> dict:
+    """
+    Convierte una línea enviada por el Arduino en un diccionario de lectura.
+
+    Acepta un objeto JSON por línea o el formato compacto
+    `tipo,sensor_id,ubicacion,estado[,valor]`.
+    """
+    if texto.startswith("{"):
+        try:
+            return json.loads(texto)
+        except ValueError as e:
+            raise LecturaInvalida(f"JSON inválido: {e}") from e
+
+    partes = [parte.strip() for parte in texto.split(",")]
+    if len(partes) not in (4, 5):
+        raise LecturaInvalida(f"Formato de línea no reconocido: {texto!r}")
+
+    tipo, sensor_id, ubicacion, estado = partes[:4]
+    lectura = {"tipo": tipo, "nombre": tipo, "sensor_id": sensor_id, "ubicacion": ubicacion, "estado": estado}
+    if len(partes) == 5 and CAMPO_VALOR.get(tipo):
+        lectura[CAMPO_VALOR[tipo]] = partes[4]
+    return lectura
+
+
+class GatewaySerial:
+    """Lee el puerto serie sin bloquear el event loop y guarda las lecturas por lotes."""
+
+    def __init__(self, puerto, baudios=BAUD_RATE, tamano_lote=TAMANO_LOTE, espera_maxima=ESPERA_MAXIMA):
+        self.puerto = puerto
+        self.baudios = baudios
+        self.buffers = {
+            tipo: BufferEscritura(f"serial-{tipo}", partial(guardar_documentos, tipo), tamano_lote, espera_maxima)
+            for tipo in SENSORES
+        }
+        self.lineas = 0
+        self.rechazadas = 0
+        self._tarea = None
+
+    def iniciar(self):
+        self._tarea = asyncio.create_task(self._ejecutar())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        # Lo que ya se leyó del puerto se guarda antes de salir
+        await asyncio.gather(*(buffer.detener() for buffer in self.buffers.values()))
+
+    async def _ejecutar(self):
+        # Si el dispositivo se desconecta se reintenta la conexión
+        while True:
+            try:
+                await self._leer_puerto()
+            except (serial.SerialException, OSError) as e:
+                print(f"Error en el puerto serie {self.puerto}: {e}")
+            await asyncio.sleep(REINTENTO_SEGUNDOS)
+
+    async def _leer_puerto(self):
+        loop = asyncio.get_running_loop()
+        lector = asyncio.StreamReader(limit=LINEA_MAXIMA)
+        puerto = serial.Serial(self.puerto, self.baudios, timeout=0)
+        detener_hilo = threading.Event()
+
+        def leer_disponible():
+            try:
+                datos = puerto.read(puerto.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                loop.remove_reader(puerto.fileno())
+                lector.set_exception(e)
+                return
+            if datos:
+                lector.feed_data(datos)
+
+        def leer_en_hilo():
+            # En Windows los puertos COM no funcionan con add_reader
+            puerto.timeout = 0.5
+            while not detener_hilo.is_set():
+                try:
+                    datos = puerto.read(puerto.in_waiting or 1)
+                except (serial.SerialException, OSError) as e:
+                    loop.call_soon_threadsafe(lector.set_exception, e)
+                    return
+                if datos:
+                    loop.call_soon_threadsafe(lector.feed_data, datos)
+
+        usa_add_reader = sys.platform != "win32"
+        if usa_add_reader:
+            loop.add_reader(puerto.fileno(), leer_disponible)
+        else:
+            threading.Thread(target=leer_en_hilo, daemon=True).start()
+
+        try:
+            while True:
+                try:
+                    linea = await lector.readline()
+                except ValueError:
+                    # Línea más larga que LINEA_MAXIMA: se descarta hasta el siguiente salto
+                    self.rechazadas += 1
+                    continue
+                if not linea:
+                    return
+                await self.procesar_linea(linea)
+        finally:
+            if usa_add_reader:
+                loop.remove_reader(puerto.fileno())
+            detener_hilo.set()
+            puerto.close()
+
+    async def procesar_linea(self, linea: bytes):
+        texto = linea.decode("utf-8", errors="replace").strip()
+        if not texto:
+            return
+        self.lineas += 1
+        try:
+            tipo, documento = validar_lectura(interpretar_linea(texto))
+        except LecturaInvalida as e:
+            self.rechazadas += 1
+            print(f"Lectura rechazada del puerto serie: {e}")
+            return
+        await self.buffers[tipo].agregar(documento)
+
+    def metricas(self) -> dict:
+        return {
+            "puerto": self.puerto,
+            "lineas": self.lineas,
+            "rechazadas": self.rechazadas,
+            "buffers": {tipo: buffer.metricas() for tipo, buffer in self.buffers.items()},
+        }
+
+
+gateway = GatewaySerial(ARDUINO_PORT) if ARDUINO_PORT else None
+
+
+async def iniciar():
+    if gateway is not None:
+        gateway.iniciar()
+
+
+async def detener():
+    if gateway is not None:
+        await gateway.detener()
+
+
+def simular_dispositivo(intervalo: float = 0.2):
+    """
+    Crea un pseudo-terminal que se comporta como un Arduino y le escribe lecturas.
+
+    Uso: `python gateway_serial.py simular` y luego iniciar el servidor con
+    ARDUINO_PORT igual a la ruta que se imprime. Solo funciona en Linux/macOS.
+    """
+    maestro, esclavo = os.openpty()
+    print(f"Dispositivo simulado en {os.ttyname(esclavo)}")
+    try:
+        while True:
+            tipo = random.choice(list(SENSORES))
+            estado = random.choice(["normal", "alerta"])
+            valor = random.randint(0, 1023)
+            os.write(maestro, f"{tipo},{tipo}-1,sala,{estado},{valor}\n".encode())
+            time.sleep(intervalo)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(maestro)
+        os.close(esclavo)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["simular"]:
+        simular_dispositivo()
+    else:
+        print("Uso: python gateway_serial.py simular")
@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import sys
+
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+import rollups
+from Modelos.user_models import collection_cliente, collection_casa
+from almacenamiento import coleccion_sensores, crear_colecciones_timeseries, indices_lecturas, ESQUEMA
+
+
+def registro() -> list:
+    """
+    Índices que necesitan las rutas, como (colección, claves, opciones).
+
+    Es la única fuente de verdad: el servidor los aplica al iniciar y
+    `python indices.py verificar` los compara con los que existen en Mongo.
+    """
+    indices = [
+        # Login, get_current_user y el alta de clientes buscan por correo
+        (collection_cliente, [("correo", 1)], {"unique": True}),
+        # Casas de un cliente; las búsquedas por {_id, usuario_id} ya usan el índice de _id
+        (collection_casa, [("usuario_id", 1)], {}),
+        # Casas que referencian un sensor, para invalidar su ETag cuando el sensor cambia
+        (collection_casa, [("sensores.sensor_obj_id", 1)], {}),
+        # Documentos del Arduino (sensor, value, timestamp) que consulta /clientes/historial
+        (coleccion_sensores("movimiento"),
+         ([("tipo", 1)] if ESQUEMA == "unificada" else []) + [("sensor", 1), ("timestamp", -1)], {}),
+    ]
+    indices += [(collection, claves, {}) for collection, claves in indices_lecturas()]
+    indices += [
+        (collection, [("tipo", 1), ("sensor_id", 1), ("inicio", 1)], {"unique": True})
+        for collection in rollups.RESOLUCIONES.values()
+    ]
+    return indices
+
+
+def _por_coleccion(indices: list) -> dict:
+    agrupados = {}
+    for collection, claves, opciones in indices:
+        agrupados.setdefault(collection.name, (collection, []))[1].append((claves, opciones))
+    return agrupados
+
+
+# Compara el registro con los índices que existen y devuelve las diferencias
+async def detectar_diferencias(indices: list = None) -> list:
+    """
+    Cada diferencia es un dict con `coleccion`, `claves` y `problema`:
+    "falta", "opciones distintas" o "no registrado".
+    """
+    diferencias = []
+    for nombre, (collection, esperados) in _por_coleccion(indices or registro()).items():
+        existentes = {
+            tuple(tuple(clave) for clave in informacion["key"]): bool(informacion.get("unique"))
+            for informacion in (await collection.index_information()).values()
+        }
+        registrados = set()
+        for claves, opciones in esperados:
+            clave = tuple((campo, direccion) for campo, direccion in claves)
+            registrados.add(clave)
+            if clave not in existentes:
+                diferencias.append({"coleccion": nombre, "claves": claves, "problema": "falta"})
+            elif existentes[clave] != bool(opciones.get("unique")):
+                diferencias.append({"coleccion": nombre, "claves": claves, "problema": "opciones distintas"})
+        for clave in existentes:
+            if clave not in registrados and clave != (("_id", 1),):
+                diferencias.append({"coleccion": nombre, "claves": list(clave), "problema": "no registrado"})
+    return diferencias
+
+
+# Crea los índices que faltan; no borra ni modifica los que ya existen
+async def aplicar(indices: list = None) -> list:
+    """Devuelve las diferencias que quedan después de aplicar, para reportarlas."""
+    indices = indices or registro()
+    try:
+        await crear_colecciones_timeseries()
+        for collection, claves, opciones in indices:
+            try:
+                await collection.create_index(claves, **opciones)
+            except ConnectionFailure:
+                raise
+            except PyMongoError as e:
+                # Un índice único sobre datos duplicados no debe impedir que el servidor arranque
+                print(f"No se pudo crear el índice {claves} en {collection.name}: {e}")
+        diferencias = await detectar_diferencias(indices)
+    except PyMongoError as e:
+        # Sin Mongo al arrancar el servidor sigue (se conecta cuando lo necesite, como antes); los
+        # índices se aplican en el siguiente arranque o con `python indices.py aplicar`
+        print(f"No se pudieron aplicar los índices: {e}")
+        return []
+
+    for diferencia in diferencias:
+        print(f"Índice {diferencia['problema']} en {diferencia['coleccion']}: {diferencia['claves']}")
+    return diferencias
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Índices de MongoDB que usa el servidor")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    subparsers.add_parser("aplicar", help="Crea los índices que faltan y reporta las diferencias")
+    subparsers.add_parser("verificar", help="Solo reporta las diferencias; termina con error si falta un índice o difiere")
+    args = parser.parse_args()
+
+    if args.comando == "aplicar":
+        asyncio.run(aplicar())
+    else:
+        diferencias = asyncio.run(detectar_diferencias())
+        for diferencia in diferencias:
+            print(f"Índice {diferencia['problema']} en {diferencia['coleccion']}: {diferencia['claves']}")
+        if not diferencias:
+            print("Los índices coinciden con el registro")
+        elif any(diferencia["problema"] != "no registrado" for diferencia in diferencias):
+            sys.exit(1)
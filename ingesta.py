@@ -0,0 +1,222 @@
+import asyncio
+import json
+import os
+from functools import partial
+
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import PyMongoError
+
+import estado_actual
+import rollups
+from Modelos.models import SENSORES
+from almacenamiento import MODO_ALMACENAMIENTO, escribir, escribir_uno
+from difusion import difusor
+from escritura_diferida import ESCRITURA_DIFERIDA, BufferEscritura
+
+
+# Lecturas por tipo que se acumulan antes de cada insert_many durante una importación
+TAMANO_BLOQUE_IMPORTACION = int(os.getenv("SENSOR_IMPORT_CHUNK", "1000"))
+# Longitud máxima de una línea NDJSON y cantidad de errores detallados en el resumen
+LINEA_MAXIMA = 64 * 1024
+ERRORES_REPORTADOS = 100
+
+
+class LecturaInvalida(ValueError):
+    """La lectura no corresponde a ningún tipo de sensor o no pasa la validación de su modelo."""
+
+
+def describir_errores(error: ValidationError) -> str:
+    """Resume los errores de Pydantic en una sola línea legible."""
+    return "; ".join(
+        f"{'.'.join(str(parte) for parte in detalle['loc'])}: {detalle['msg']}"
+        for detalle in error.errors()
+    )
+
+
+def validar_lectura(lectura) -> tuple:
+    """Valida una lectura contra el modelo de su tipo y devuelve (tipo, documento)."""
+    if not isinstance(lectura, dict):
+        raise LecturaInvalida("La lectura debe ser un objeto JSON")
+
+    tipo = lectura.get("tipo")
+    if tipo not in SENSORES:
+        raise LecturaInvalida(f"Tipo de sensor no válido: {tipo}")
+
+    modelo, _ = SENSORES[tipo]
+    try:
+        sensor = modelo(**lectura)
+    except ValidationError as e:
+        raise LecturaInvalida(describir_errores(e)) from e
+    return tipo, sensor.dict()
+
+
+# Guarda los documentos de un tipo en un solo lote según el modo de almacenamiento
+async def guardar_documentos(tipo: str, documentos: list) -> list:
+    """Devuelve una lista paralela a `documentos` con None si se guardó o el mensaje de error."""
+    try:
+        errores = await escribir(tipo, documentos)
+    except PyMongoError as e:
+        return [f"Error al guardar la lectura: {str(e)}"] * len(documentos)
+
+    guardados = [documento for documento, error in zip(documentos, errores) if error is None]
+    estado_actual.registrar(tipo, guardados)
+    await rollups.registrar(tipo, guardados)
+    publicar(tipo, guardados)
+    return errores
+
+
+def publicar(tipo: str, documentos: list):
+    # En timeseries y buckets los change streams no entregan las lecturas (ver almacenamiento.colecciones_observables)
+    if MODO_ALMACENAMIENTO != "documentos" and documentos:
+        difusor.publicar_lecturas(tipo, documentos)
+
+
+# Valida una lista mixta de lecturas, las agrupa por tipo y guarda cada grupo en un lote
+async def insertar_lecturas(lecturas: list) -> list:
+    """Devuelve un resultado por lectura, en el mismo orden en que se recibieron."""
+    resultados = [None] * len(lecturas)
+    grupos = {}
+
+    for indice, lectura in enumerate(lecturas):
+        try:
+            tipo, documento = validar_lectura(lectura)
+        except LecturaInvalida as e:
+            resultados[indice] = {"indice": indice, "ok": False, "error": str(e)}
+            continue
+        indices, documentos = grupos.setdefault(tipo, ([], []))
+        indices.append(indice)
+        documentos.append(documento)
+
+    # Un insert_many por tipo, todos en paralelo
+    tipos = list(grupos)
+    errores_por_tipo = await asyncio.gather(
+        *(guardar_documentos(tipo, grupos[tipo][1]) for tipo in tipos)
+    )
+
+    for tipo, errores in zip(tipos, errores_por_tipo):
+        indices, documentos = grupos[tipo]
+        for indice, documento, error in zip(indices, documentos, errores):
+            if error is None:
+                resultados[indice] = {"indice": indice, "ok": True, "tipo": tipo, "id": str(documento["_id"])}
+            else:
+                resultados[indice] = {"indice": indice, "ok": False, "tipo": tipo, "error": error}
+
+    return resultados
+
+
+async def _lineas(fragmentos):
+    """Convierte un flujo de bytes en líneas sin cargar el cuerpo completo en memoria."""
+    pendiente = bytearray()
+    descartando = False
+    async for fragmento in fragmentos:
+        pendiente.extend(fragmento)
+        inicio = 0
+        while True:
+            fin = pendiente.find(b"\n", inicio)
+            if fin == -1:
+                break
+            if descartando:
+                # Fin de una línea demasiado larga que ya se reportó
+                descartando = False
+            else:
+                yield bytes(pendiente[inicio:fin])
+            inicio = fin + 1
+        del pendiente[:inicio]
+        if len(pendiente) > LINEA_MAXIMA:
+            # Se descarta el resto de la línea; se reporta una sola vez con su número
+            if not descartando:
+                yield None
+                descartando = True
+            pendiente.clear()
+    if pendiente and not descartando:
+        yield bytes(pendiente)
+
+
+# Importa lecturas en formato NDJSON (una lectura JSON por línea) en bloques
+async def importar_ndjson(fragmentos, tamano_bloque: int = TAMANO_BLOQUE_IMPORTACION) -> dict:
+    """
+    Valida cada línea al vuelo y guarda las lecturas con un insert_many por tipo
+    cada vez que se juntan `tamano_bloque`. Devuelve el resumen de la importación.
+    """
+    resumen = {"lineas": 0, "aceptadas": 0, "rechazadas": 0, "errores": []}
+    bloques = {}
+
+    def rechazar(numero, mensaje):
+        resumen["rechazadas"] += 1
+        if len(resumen["errores"]) < ERRORES_REPORTADOS:
+            resumen["errores"].append({"linea": numero, "error": mensaje})
+
+    async def guardar_bloque(tipo):
+        numeros, documentos = bloques.pop(tipo)
+        errores = await guardar_documentos(tipo, documentos)
+        for numero, error in zip(numeros, errores):
+            if error is None:
+                resumen["aceptadas"] += 1
+            else:
+                rechazar(numero, error)
+
+    numero = 0
+    async for linea in _lineas(fragmentos):
+        numero += 1
+        if linea is None:
+            rechazar(numero, f"La línea excede el máximo de {LINEA_MAXIMA} bytes")
+            continue
+        if not linea.strip():
+            continue
+        resumen["lineas"] += 1
+
+        try:
+            tipo, documento = validar_lectura(json.loads(linea))
+        except (ValueError, LecturaInvalida) as e:
+            # json.JSONDecodeError y LecturaInvalida son ValueError
+            rechazar(numero, str(e))
+            continue
+
+        numeros, documentos = bloques.setdefault(tipo, ([], []))
+        numeros.append(numero)
+        documentos.append(documento)
+        if len(documentos) >= tamano_bloque:
+            await guardar_bloque(tipo)
+
+    for tipo in list(bloques):
+        await guardar_bloque(tipo)
+
+    return resumen
+
+
+# Buffers de escritura diferida, uno por tipo de sensor
+buffers = {tipo: BufferEscritura(tipo, partial(guardar_documentos, tipo)) for tipo in SENSORES}
+
+
+# Guarda una sola lectura ya validada y devuelve su _id
+async def guardar_lectura(tipo: str, documento: dict) -> ObjectId:
+    """Con escritura diferida solo espera a que la lectura entre al buffer, no a Mongo."""
+    if ESCRITURA_DIFERIDA:
+        documento.setdefault("_id", ObjectId())
+        await buffers[tipo].agregar(documento)
+        return documento["_id"]
+
+    inserted_id = await escribir_uno(tipo, documento)
+    estado_actual.actualizar(tipo, documento)
+    await rollups.registrar(tipo, [documento])
+    publicar(tipo, [documento])
+    return inserted_id
+
+
+async def iniciar():
+    if ESCRITURA_DIFERIDA:
+        for buffer in buffers.values():
+            buffer.iniciar()
+
+
+async def detener():
+    """Escribe lo que quede en los buffers antes de apagar el servidor."""
+    await asyncio.gather(*(buffer.detener() for buffer in buffers.values()))
+
+
+def metricas_escritura() -> dict:
+    return {
+        "escritura_diferida": ESCRITURA_DIFERIDA,
+        "buffers": {tipo: buffer.metricas() for tipo, buffer in buffers.items()},
+    }
@@ -1,10 +1,37 @@
 # main.py
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
+import difusion
+import estado_actual
+import gateway_serial
+import indices
+import ingesta
+import retencion
 from Routes import admin, Sensores, cliente
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Colecciones time-series e índices del registro; las diferencias se reportan en el log
+    await indices.aplicar()
+    await estado_actual.iniciar()
+    # Un change stream por colección compartido por todos los sockets de /ws/sensores
+    await difusion.iniciar()
+    await ingesta.iniciar()
+    await gateway_serial.iniciar()
+    await retencion.iniciar()
+    yield
+    await retencion.detener()
+    await difusion.detener()
+    # Vaciar los buffers de escritura diferida antes de apagar
+    await gateway_serial.detener()
+    await ingesta.detener()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(Sensores.router)
 app.include_router(admin.router)
 app.include_router(cliente.router)
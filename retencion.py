@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bson import ObjectId
+
+from Modelos.models import SENSORES, utc_sin_zona
+from almacenamiento import consultar_lecturas, eliminar_lecturas
+
+# Días que cada tipo de lectura se conserva en Mongo antes de pasar al archivo local (0 = sin límite).
+# SENSOR_RETENTION_DAYS aplica a todos y SENSOR_RETENTION_DAYS_<TIPO> lo reemplaza para un tipo.
+RETENCION_DIAS = {
+    tipo: int(os.getenv(f"SENSOR_RETENTION_DAYS_{tipo.upper()}", os.getenv("SENSOR_RETENTION_DAYS", "0")))
+    for tipo in SENSORES
+}
+DIRECTORIO_ARCHIVO = os.getenv("SENSOR_ARCHIVE_DIR", "archivo")
+LOTE_ARCHIVO = int(os.getenv("SENSOR_ARCHIVE_BATCH", "5000"))
+# Cada cuántas horas se aplica la retención desde el servidor (0 = solo por línea de comandos)
+INTERVALO_HORAS = float(os.getenv("SENSOR_RETENTION_INTERVAL_HOURS", "0"))
+
+OPERADORES_RANGO = {"$gte", "$gt", "$lte", "$lt"}
+
+
+def fecha_corte(tipo: str):
+    """Las lecturas anteriores a esta fecha están en el archivo, no en Mongo."""
+    dias = RETENCION_DIAS.get(tipo, 0)
+    if not dias:
+        return None
+    return datetime.utcnow() - timedelta(days=dias)
+
+
+def _directorio_dia(tipo: str, dia) -> str:
+    return os.path.join(DIRECTORIO_ARCHIVO, tipo, f"fecha={dia.isoformat()}")
+
+
+def _a_fila(documento: dict) -> dict:
+    return {clave: str(valor) if isinstance(valor, ObjectId) else valor for clave, valor in documento.items()}
+
+
+def _escribir_parquet(tipo: str, dia, filas: list):
+    """Escribe una parte del día en Parquet comprimido con zstd; el rename evita archivos a medias."""
+    directorio = _directorio_dia(tipo, dia)
+    os.makedirs(directorio, exist_ok=True)
+    destino = os.path.join(directorio, f"{ObjectId()}.parquet")
+    temporal = destino + ".tmp"
+    # Las lecturas de un tipo no siempre traen los mismos campos; se usa la unión de columnas
+    columnas = list(dict.fromkeys(clave for fila in filas for clave in fila))
+    tabla = pa.Table.from_pylist([{columna: fila.get(columna) for columna in columnas} for fila in filas])
+    pq.write_table(tabla, temporal, compression="zstd")
+    os.replace(temporal, destino)
+
+
+async def _archivar_bloque(tipo: str, por_dia: dict) -> int:
+    for dia, filas in por_dia.items():
+        await asyncio.to_thread(_escribir_parquet, tipo, dia, filas)
+    # Solo se borra de Mongo lo que ya quedó escrito en disco
+    ids = [ObjectId(fila["_id"]) for filas in por_dia.values() for fila in filas]
+    for inicio in range(0, len(ids), 1000):
+        await eliminar_lecturas(tipo, ids[inicio:inicio + 1000])
+    return len(ids)
+
+
+# Exporta al archivo las lecturas más antiguas que la retención de su tipo y las borra de Mongo
+async def archivar(tipos=None, tamano_lote: int = LOTE_ARCHIVO):
+    for tipo in tipos or SENSORES:
+        corte = fecha_corte(tipo)
+        if corte is None:
+            continue
+
+        archivadas, por_dia, pendientes = 0, {}, 0
+        async for documento in consultar_lecturas(tipo, {"fecha_hora": {"$lt": corte}}):
+            por_dia.setdefault(documento["fecha_hora"].date(), []).append(_a_fila(documento))
+            pendientes += 1
+            if pendientes >= tamano_lote:
+                archivadas += await _archivar_bloque(tipo, por_dia)
+                por_dia, pendientes = {}, 0
+        if por_dia:
+            archivadas += await _archivar_bloque(tipo, por_dia)
+
+        print(f"{tipo}: {archivadas} lecturas anteriores a {corte:%Y-%m-%d} archivadas")
+
+
+def _cumple(fila: dict, filtro: dict) -> bool:
+    """Evalúa en memoria los filtros que admite el archivo: igualdad y rangos."""
+    for campo, condicion in filtro.items():
+        valor = fila.get(campo)
+        if isinstance(condicion, dict) and set(condicion) <= OPERADORES_RANGO:
+            if valor is None:
+                return False
+            if "$gte" in condicion and not valor >= condicion["$gte"]:
+                return False
+            if "$gt" in condicion and not valor > condicion["$gt"]:
+                return False
+            if "$lte" in condicion and not valor <= condicion["$lte"]:
+                return False
+            if "$lt" in condicion and not valor < condicion["$lt"]:
+                return False
+        elif valor != condicion:
+            return False
+    return True
+
+
+def _leer_dia(tipo: str, dia, filtro: dict) -> list:
+    directorio = _directorio_dia(tipo, dia)
+    filas = []
+    for nombre in sorted(os.listdir(directorio)):
+        if not nombre.endswith(".parquet"):
+            continue
+        for fila in pq.read_table(os.path.join(directorio, nombre)).to_pylist():
+            if _cumple(fila, filtro):
+                filas.append(fila)
+    return filas
+
+
+# Recorre las lecturas archivadas de un tipo, solo en los días que toca el filtro de fecha_hora
+async def consultar_archivo(tipo: str, filtro: dict = None):
+    filtro = filtro or {}
+    directorio_tipo = os.path.join(DIRECTORIO_ARCHIVO, tipo)
+    if not os.path.isdir(directorio_tipo):
+        return
+
+    rango = filtro.get("fecha_hora") if isinstance(filtro.get("fecha_hora"), dict) else {}
+    desde = rango.get("$gte") or rango.get("$gt")
+    hasta = rango.get("$lte") or rango.get("$lt")
+
+    dias = sorted(
+        datetime.strptime(nombre[len("fecha="):], "%Y-%m-%d").date()
+        for nombre in os.listdir(directorio_tipo) if nombre.startswith("fecha=")
+    )
+    for dia in dias:
+        if (desde and dia < desde.date()) or (hasta and dia > hasta.date()):
+            continue
+        for fila in await asyncio.to_thread(_leer_dia, tipo, dia, filtro):
+            yield fila
+
+
+# Lecturas de Mongo y del archivo con un solo recorrido, para consultas históricas
+async def consultar_historico(tipo: str, filtro: dict = None):
+    """El archivo solo se lee si el rango pedido empieza antes de la fecha de corte del tipo."""
+    filtro = filtro or {}
+    corte = fecha_corte(tipo)
+    rango = filtro.get("fecha_hora") if isinstance(filtro.get("fecha_hora"), dict) else {}
+    desde = utc_sin_zona(rango.get("$gte") or rango.get("$gt"))
+
+    if corte is not None and (desde is None or desde < corte):
+        async for fila in consultar_archivo(tipo, filtro):
+            yield fila
+    async for documento in consultar_lecturas(tipo, filtro):
+        yield documento
+
+
+async def aplicar_periodicamente():
+    """Tarea del servidor que aplica la retención cada INTERVALO_HORAS."""
+    while True:
+        try:
+            await archivar()
+        except Exception as e:
+            print(f"Error al aplicar la retención: {e}")
+        await asyncio.sleep(INTERVALO_HORAS * 3600)
+
+
+_tarea = None
+
+
+async def iniciar():
+    global _tarea
+    if INTERVALO_HORAS > 0:
+        _tarea = asyncio.create_task(aplicar_periodicamente())
+
+
+async def detener():
+    global _tarea
+    if _tarea is not None:
+        _tarea.cancel()
+        try:
+            await _tarea
+        except asyncio.CancelledError:
+            pass
+        _tarea = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retención de lecturas con archivo local en Parquet")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    parser_archivar = subparsers.add_parser("archivar", help="Exporta y borra las lecturas fuera de la retención")
+    parser_archivar.add_argument("--tipo", choices=list(SENSORES), action="append")
+    parser_archivar.add_argument("--lote", type=int, default=LOTE_ARCHIVO)
+    args = parser.parse_args()
+
+    asyncio.run(archivar(args.tipo, args.lote))
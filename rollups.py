@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from Modelos.models import SENSORES, CAMPO_VALOR, database, utc_sin_zona
+from almacenamiento import pipeline_lecturas
+
+# Agregados por sensor (mínimo, máximo, promedio, cantidad y último valor) en cubetas de tiempo
+ROLLUPS_ACTIVOS = os.getenv("SENSOR_ROLLUPS", "1") == "1"
+
+RESOLUCIONES = {
+    "minuto": database['Rollups_minuto'],
+    "hora": database['Rollups_hora'],
+    "dia": database['Rollups_dia'],
+}
+
+# Unidad de $dateTrunc de cada resolución
+UNIDADES = {"minuto": "minute", "hora": "hour", "dia": "day"}
+
+
+def inicio_cubeta(fecha: datetime, resolucion: str) -> datetime:
+    """Inicio de la cubeta a la que pertenece una fecha, en UTC como las que arma $dateTrunc."""
+    fecha = utc_sin_zona(fecha)
+    if resolucion == "minuto":
+        return fecha.replace(second=0, microsecond=0)
+    if resolucion == "hora":
+        return fecha.replace(minute=0, second=0, microsecond=0)
+    return fecha.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def preparar():
+    # El índice único es necesario para el $merge de la reconstrucción
+    for collection in RESOLUCIONES.values():
+        await collection.create_index(
+            [("tipo", ASCENDING), ("sensor_id", ASCENDING), ("inicio", ASCENDING)], unique=True
+        )
+
+
+def _acumular(tipo: str, documentos: list) -> dict:
+    """Resume un lote de lecturas por (resolución, sensor_id, inicio) antes de escribir."""
+    campo = CAMPO_VALOR.get(tipo)
+    parciales = {}
+    if campo is None:
+        return parciales
+
+    for documento in documentos:
+        valor = documento.get(campo)
+        fecha = utc_sin_zona(documento.get("fecha_hora"))
+        sensor_id = documento.get("sensor_id")
+        if not isinstance(valor, (int, float)) or fecha is None or sensor_id is None:
+            continue
+        for resolucion in RESOLUCIONES:
+            clave = (resolucion, sensor_id, inicio_cubeta(fecha, resolucion))
+            parcial = parciales.get(clave)
+            if parcial is None:
+                parciales[clave] = {"minimo": valor, "maximo": valor, "suma": valor, "cantidad": 1,
+                                    "ultimo": valor, "ultimo_fecha": fecha}
+                continue
+            parcial["minimo"] = min(parcial["minimo"], valor)
+            parcial["maximo"] = max(parcial["maximo"], valor)
+            parcial["suma"] += valor
+            parcial["cantidad"] += 1
+            if fecha >= parcial["ultimo_fecha"]:
+                parcial["ultimo"], parcial["ultimo_fecha"] = valor, fecha
+    return parciales
+
+
+def _actualizacion(parcial: dict) -> list:
+    """Pipeline de actualización que combina un parcial con lo que ya tiene la cubeta."""
+    return [{"$set": {
+        "minimo": {"$min": ["$minimo", parcial["minimo"]]},
+        "maximo": {"$max": ["$maximo", parcial["maximo"]]},
+        "suma": {"$add": [{"$ifNull": ["$suma", 0]}, parcial["suma"]]},
+        "cantidad": {"$add": [{"$ifNull": ["$cantidad", 0]}, parcial["cantidad"]]},
+        # Las referencias a campos dentro del mismo $set leen el valor anterior del documento
+        "ultimo": {"$cond": [
+            {"$gte": [parcial["ultimo_fecha"], {"$ifNull": ["$ultimo_fecha", datetime.min]}]},
+            {"$literal": parcial["ultimo"]},
+            "$ultimo",
+        ]},
+        "ultimo_fecha": {"$max": ["$ultimo_fecha", parcial["ultimo_fecha"]]},
+    }}]
+
+
+# Actualiza las cubetas con lecturas recién guardadas, sin volver a leer las colecciones
+async def registrar(tipo: str, documentos: list):
+    if not ROLLUPS_ACTIVOS:
+        return
+
+    operaciones = {resolucion: [] for resolucion in RESOLUCIONES}
+    for (resolucion, sensor_id, inicio), parcial in _acumular(tipo, documentos).items():
+        operaciones[resolucion].append(UpdateOne(
+            {"tipo": tipo, "sensor_id": sensor_id, "inicio": inicio},
+            _actualizacion(parcial),
+            upsert=True,
+        ))
+
+    try:
+        await asyncio.gather(*(
+            RESOLUCIONES[resolucion].bulk_write(lista, ordered=False)
+            for resolucion, lista in operaciones.items() if lista
+        ))
+    except PyMongoError as e:
+        # Un fallo en los agregados no debe rechazar lecturas que ya se guardaron
+        print(f"Error al actualizar los rollups de {tipo}: {e}")
+
+
+# Devuelve la serie preagregada de un sensor
+async def consultar(tipo: str, sensor_id: str, resolucion: str, desde: datetime = None, hasta: datetime = None,
+                    limite: int = 1000) -> list:
+    filtro = {"tipo": tipo, "sensor_id": sensor_id}
+    if desde or hasta:
+        filtro["inicio"] = {}
+        if desde:
+            filtro["inicio"]["$gte"] = inicio_cubeta(desde, resolucion)
+        if hasta:
+            filtro["inicio"]["$lte"] = hasta
+    cursor = RESOLUCIONES[resolucion].find(filtro, {"_id": 0}).sort("inicio", ASCENDING).limit(limite)
+
+    serie = []
+    async for cubeta in cursor:
+        serie.append({
+            "inicio": cubeta["inicio"],
+            "minimo": cubeta["minimo"],
+            "maximo": cubeta["maximo"],
+            "promedio": cubeta["suma"] / cubeta["cantidad"],
+            "cantidad": cubeta["cantidad"],
+            "ultimo": cubeta["ultimo"],
+        })
+    return serie
+
+
+# Recalcula las cubetas a partir de las lecturas guardadas
+async def reconstruir(tipos=None, desde: datetime = None):
+    """Usa $group y $merge en el servidor; reemplaza las cubetas que ya existían."""
+    await preparar()
+    for tipo in tipos or SENSORES:
+        campo = CAMPO_VALOR.get(tipo)
+        if campo is None:
+            print(f"{tipo}: no tiene valor numérico, se omite")
+            continue
+
+        filtro = {campo: {"$type": "number"}, "sensor_id": {"$ne": None}, "fecha_hora": {"$type": "date"}}
+        if desde:
+            # El $merge reemplaza cubetas completas: se empieza en el inicio del día de `desde` para que
+            # ninguna cubeta (de minuto, hora o día) se reemplace con solo una parte de sus lecturas
+            filtro["fecha_hora"]["$gte"] = inicio_cubeta(desde, "dia")
+        collection, etapas = pipeline_lecturas(tipo, filtro)
+
+        for resolucion, destino in RESOLUCIONES.items():
+            pipeline = etapas + [
+                {"$group": {
+                    "_id": {
+                        "sensor_id": "$sensor_id",
+                        "inicio": {"$dateTrunc": {"date": "$fecha_hora", "unit": UNIDADES[resolucion]}},
+                    },
+                    "minimo": {"$min": f"${campo}"},
+                    "maximo": {"$max": f"${campo}"},
+                    "suma": {"$sum": f"${campo}"},
+                    "cantidad": {"$sum": 1},
+                    "ultimo": {"$top": {"sortBy": {"fecha_hora": -1}, "output": [f"${campo}", "$fecha_hora"]}},
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "tipo": {"$literal": tipo},
+                    "sensor_id": "$_id.sensor_id",
+                    "inicio": "$_id.inicio",
+                    "minimo": 1,
+                    "maximo": 1,
+                    "suma": 1,
+                    "cantidad": 1,
+                    "ultimo": {"$arrayElemAt": ["$ultimo", 0]},
+                    "ultimo_fecha": {"$arrayElemAt": ["$ultimo", 1]},
+                }},
+                {"$merge": {
+                    "into": destino.name,
+                    "on": ["tipo", "sensor_id", "inicio"],
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }},
+            ]
+            await collection.aggregate(pipeline).to_list(length=None)
+        print(f"{tipo}: rollups reconstruidos")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Agregados por minuto, hora y día de las lecturas")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    parser_reconstruir = subparsers.add_parser("reconstruir", help="Recalcula los rollups desde las lecturas")
+    parser_reconstruir.add_argument("--tipo", choices=list(SENSORES), action="append")
+    parser_reconstruir.add_argument("--desde", type=datetime.fromisoformat,
+                                    help="Solo desde el día de esta fecha (ISO 8601)")
+    args = parser.parse_args()
+
+    asyncio.run(reconstruir(args.tipo, args.desde))
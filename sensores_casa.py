@@ -0,0 +1,38 @@
+import asyncio
+
+from bson import ObjectId
+
+from almacenamiento import buscar_sensores
+
+
+# Resuelve las referencias {sensor_obj_id, sensor_tipo} de una casa a los datos de cada sensor
+async def resolver_sensores(referencias: list) -> list:
+    """
+    Agrupa las referencias por tipo y hace una consulta $in por tipo, todas en
+    paralelo. El resultado conserva el orden de `referencias`; las referencias
+    incompletas o que apuntan a un sensor que ya no existe se omiten.
+    """
+    validas = [
+        (referencia["sensor_tipo"], ObjectId(referencia["sensor_obj_id"]))
+        for referencia in referencias
+        if referencia.get("sensor_tipo") and ObjectId.is_valid(referencia.get("sensor_obj_id"))
+    ]
+
+    ids_por_tipo = {}
+    for tipo, sensor_obj_id in validas:
+        ids_por_tipo.setdefault(tipo, []).append(sensor_obj_id)
+    tipos = list(ids_por_tipo)
+    encontrados = dict(zip(tipos, await asyncio.gather(
+        *(buscar_sensores(tipo, ids_por_tipo[tipo], {"ubicacion": 1}) for tipo in tipos)
+    )))
+
+    sensores = []
+    for tipo, sensor_obj_id in validas:
+        sensor_info = encontrados[tipo].get(sensor_obj_id)
+        if sensor_info:
+            sensores.append({
+                "_id": str(sensor_info["_id"]),
+                "tipo": tipo,
+                "ubicacion": sensor_info.get("ubicacion", ""),
+            })
+    return sensores
@@ -0,0 +1,64 @@
+from decimal import Decimal
+
+import orjson
+from bson import ObjectId, Decimal128
+from bson.timestamp import Timestamp
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+# orjson escribe los datetime en ISO 8601 igual que datetime.isoformat(); los naive quedan sin zona
+OPCIONES = orjson.OPT_NON_STR_KEYS
+
+
+def _por_defecto(valor):
+    """Tipos de BSON que orjson no conoce."""
+    if isinstance(valor, (ObjectId, Timestamp)):
+        return str(valor)
+    if isinstance(valor, Decimal128):
+        return str(valor.to_decimal())
+    if isinstance(valor, Decimal):
+        return str(valor)
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def a_json(documento) -> bytes:
+    """Convierte documentos de Mongo (o listas y dicts que los contengan) directo a bytes JSON."""
+    return orjson.dumps(documento, default=_por_defecto, option=OPCIONES)
+
+
+def a_texto(documento) -> str:
+    """Igual que a_json pero como str, para WebSocket y respuestas por streaming."""
+    return a_json(documento).decode()
+
+
+class RespuestaJSON(Response):
+    """
+    Respuesta que serializa con a_json sin pasar por jsonable_encoder ni por el
+    response_model; las rutas de listados la devuelven directamente.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return a_json(content)
+
+
+def campos_solicitados(fields: str, permitidos) -> list:
+    """Valida `fields=a,b,c` contra la lista de campos del recurso; None si no se pidió ninguno."""
+    if not fields:
+        return None
+    campos = list(dict.fromkeys(campo.strip() for campo in fields.split(",") if campo.strip()))
+    invalidos = [campo for campo in campos if campo not in permitidos]
+    if invalidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Campos no permitidos: {', '.join(invalidos)}. Disponibles: {', '.join(permitidos)}"
+        )
+    return campos
+
+
+def proyeccion(campos: list, nombres: dict = None) -> dict:
+    """Proyección de Mongo para los campos pedidos; `nombres` traduce campos de la respuesta a los de Mongo."""
+    if campos is None:
+        return None
+    nombres = nombres or {}
+    return {nombres.get(campo, campo): 1 for campo in campos}
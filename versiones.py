@@ -0,0 +1,59 @@
+import hashlib
+
+from bson import ObjectId
+from fastapi import Request
+from fastapi.responses import Response
+
+from Modelos.user_models import collection_casa, collection_cliente
+
+# Contadores que suben cada vez que el admin modifica el recurso:
+# - en el cliente, VERSION_CASAS cubre sus listados de casas
+# - en la casa, VERSION_SENSORES cubre su lista de sensores
+VERSION_CASAS = "version_casas"
+VERSION_SENSORES = "version_sensores"
+
+# Se combinan con el $push de cada escritura para que la versión suba en la misma operación
+SUBIR_VERSION_CASAS = {"$inc": {VERSION_CASAS: 1}}
+SUBIR_VERSION_SENSORES = {"$inc": {VERSION_SENSORES: 1}}
+
+
+def etag(*partes) -> str:
+    """ETag fuerte a partir del recurso, su versión y los parámetros que cambian la respuesta."""
+    return '"' + hashlib.sha1(":".join(str(parte) for parte in partes).encode()).hexdigest()[:20] + '"'
+
+
+def coincide(request: Request, valor: str) -> bool:
+    """True si el If-None-Match de la petición ya tiene esta versión."""
+    encabezado = request.headers.get("if-none-match")
+    if not encabezado:
+        return False
+    etiquetas = [etiqueta.strip().removeprefix("W/") for etiqueta in encabezado.split(",")]
+    return "*" in etiquetas or valor in etiquetas
+
+
+def no_modificado(valor: str) -> Response:
+    return Response(status_code=304, headers={"ETag": valor, "Cache-Control": "no-cache"})
+
+
+def encabezados(valor: str) -> dict:
+    # no-cache: el cliente puede guardar la respuesta pero debe revalidarla con If-None-Match
+    return {"ETag": valor, "Cache-Control": "no-cache"}
+
+
+async def version_casas(cliente_id: str) -> int:
+    """Lee solo el contador del cliente; es lo único que se consulta cuando la respuesta es 304."""
+    cliente = await collection_cliente.find_one({"_id": ObjectId(cliente_id)}, {VERSION_CASAS: 1})
+    return (cliente or {}).get(VERSION_CASAS, 0)
+
+
+async def subir_version_sensores_de(sensor_obj_id: ObjectId) -> list:
+    """
+    Sube VERSION_SENSORES en las casas que referencian un registro de sensor que se
+    modificó o eliminó fuera de las rutas de casas; devuelve los _id de esas casas.
+    """
+    # sensor_obj_id se guardó como ObjectId o como texto según la ruta que agregó el sensor
+    filtro = {"sensores.sensor_obj_id": {"$in": [sensor_obj_id, str(sensor_obj_id)]}}
+    casas = [casa["_id"] async for casa in collection_casa.find(filtro, {"_id": 1})]
+    if casas:
+        await collection_casa.update_many({"_id": {"$in": casas}}, SUBIR_VERSION_SENSORES)
+    return casas